@@ -2,8 +2,9 @@
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from streamlit_lottie import st_lottie
-import socket
 import json
 from pathlib import Path
 
@@ -13,8 +14,10 @@ LOGIN_URL = f"{BACKEND_BASE}/login"
 SIGNUP_URL = f"{BACKEND_BASE}/signup"
 PROFILE_URL = f"{BACKEND_BASE}/profile"
 VIDEO_URL = f"{BACKEND_BASE}/video"
-ESP_IP = "10.87.74.192"
-ESP_CMD_PORT = 8001
+MOTOR_URL = f"{BACKEND_BASE}/esp/cmd"   # the backend holds the only connection to the ESP
+HTTP_TIMEOUT = (3.05, 10)   # (connect, read) seconds for every backend call
+HTTP_POOL_SIZE = 16         # keep-alive connections to the backend, shared by all sessions
+PROFILE_CACHE_TTL = 30      # seconds a fetched profile is reused across reruns
 
 # ---------------- PAGE CONFIG ----------------
 st.set_page_config(page_title="Oculus Repairo", layout="wide", page_icon="🦯")
@@ -35,6 +38,8 @@ if "username" not in st.session_state:
     st.session_state["username"] = None
 if "horcrux_mode" not in st.session_state:
     st.session_state["horcrux_mode"] = False
+if "token" not in st.session_state:
+    st.session_state["token"] = None
 
 # ---------------- HORCRUX THEME ----------------
 def apply_horcrux_theme():
@@ -65,13 +70,47 @@ def apply_horcrux_theme():
 
 apply_horcrux_theme()
 
+# ---------------- BACKEND CLIENT ----------------
+@st.cache_resource
+def http_client():
+    # one pooled, keep-alive session per Streamlit process, shared by all browser sessions.
+    # Nothing per-user is stored on it: the session token goes with each request instead.
+    session = requests.Session()
+    # only failed connects are retried; a POST that reached the backend is never resent
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def auth_headers(token=None):
+    token = token or st.session_state.get("token")
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+def api_get(url, token=None, **kwargs):
+    return http_client().get(url, headers=auth_headers(token), timeout=HTTP_TIMEOUT, **kwargs)
+
+def api_post(url, token=None, **kwargs):
+    return http_client().post(url, headers=auth_headers(token), timeout=HTTP_TIMEOUT, **kwargs)
+
+@st.cache_data(ttl=PROFILE_CACHE_TTL, show_spinner=False)
+def fetch_profile(username, token):
+    """
+    Cached per (username, token), so reruns within the TTL make no request at all and a new
+    login never sees another session's entry. Errors raise, and raised errors are not cached.
+    """
+    resp = api_get(f"{PROFILE_URL}/{username}", token=token)
+    resp.raise_for_status()
+    return resp.json().get("profile", {})
+
 # ---------------- AUTH FUNCTIONS ----------------
 def login_user(username, password):
     try:
-        res = requests.post(LOGIN_URL, json={"username": username, "password": password})
+        res = api_post(LOGIN_URL, json={"username": username, "password": password})
         if res.status_code == 200:
             st.session_state["logged_in"] = True
             st.session_state["username"] = username
+            st.session_state["token"] = res.json().get("token")
             return True
         else:
             st.error(res.json().get("error", "Login failed"))
@@ -82,7 +121,7 @@ def login_user(username, password):
 
 def signup_user(data):
     try:
-        res = requests.post(SIGNUP_URL, json=data)
+        res = api_post(SIGNUP_URL, json=data)
         if res.status_code == 200:
             st.success("✅ Signup successful! You can now log in.")
         else:
@@ -93,8 +132,20 @@ def signup_user(data):
 def logout_user():
     st.session_state["logged_in"] = False
     st.session_state["username"] = None
+    st.session_state["token"] = None
     st.rerun()
 
+def load_profile():
+    """Profile of the logged-in user, or None if the backend refused it."""
+    try:
+        return fetch_profile(st.session_state["username"], st.session_state["token"])
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 401:
+            # the session token expired (or the backend restarted without SESSION_SECRET)
+            st.warning("Session expired, please log in again.")
+            logout_user()
+        return None
+
 # ---------------- LOGIN / SIGNUP ----------------
 if not st.session_state["logged_in"]:
     st.markdown("<h1 style='text-align:center;'>🦯 Horcrux Assistive App</h1>", unsafe_allow_html=True)
@@ -157,9 +208,8 @@ tabs = st.tabs(["👤 Profile Dashboard", "📷 Camera & Control", "📍 Locatio
 with tabs[0]:
     st.header("👤 User Profile")
     try:
-        resp = requests.get(f"{PROFILE_URL}/{st.session_state['username']}")
-        if resp.ok:
-            data = resp.json().get("profile", {})
+        data = load_profile()
+        if data is not None:
             st.markdown("### 🧾 Profile Summary")
             st.markdown(f"**Full Name:** {data.get('full_name', '-')}") 
             st.markdown(f"**Age:** {data.get('age', '-')}") 
@@ -172,28 +222,16 @@ with tabs[0]:
         st.error(f"Backend error: {e}")
 
 # -------- CAMERA TAB --------
-def send_motor_direct_tcp(cmd, timeout=1.0):
-    cmd_clean = (cmd or "").strip()
-    if not cmd_clean:
-        return False, "empty cmd"
-    text = (cmd_clean + "\n").encode('ascii')
+def send_motor_cmd(cmd):
+    """Returns (ok, esp_resp_or_error); esp_resp is None when the ESP did not answer."""
     try:
-        with socket.create_connection((ESP_IP, ESP_CMD_PORT), timeout=timeout) as s:
-            s.sendall(text)
-            s.settimeout(0.5)
-            try:
-                r = s.recv(256)
-                if r:
-                    try:
-                        return True, r.decode('ascii', errors='ignore').strip()
-                    except:
-                        return True, str(r)
-                else:
-                    return True, None
-            except Exception:
-                return True, None
+        res = api_post(MOTOR_URL, json={"cmd": cmd})
+        data = res.json()
     except Exception as e:
         return False, str(e)
+    if res.ok:
+        return True, data.get("esp_resp")
+    return False, data.get("detail") or data.get("error", f"HTTP {res.status_code}")
 
 with tabs[1]:
     st.header("📷 Live Camera Feed + Device Control")
@@ -205,21 +243,21 @@ with tabs[1]:
         st.caption("If blank, check merged_main.py and VIDEO_URL.")
     with right_col:
         st.subheader("🎮 Controls")
-        st.markdown("Use these buttons to send motor commands via TCP.")
+        st.markdown("Use these buttons to send motor commands through the backend.")
         status_box = st.empty()
         c1, c2 = st.columns(2)
         if c1.button("⬅️ Left", key="left_btn"):
-            ok, msg = send_motor_direct_tcp("left")
+            ok, msg = send_motor_cmd("left")
             status_box.success(f"Sent LEFT — {msg}" if ok else f"Error: {msg}")
         if c2.button("➡️ Right", key="right_btn"):
-            ok, msg = send_motor_direct_tcp("right")
+            ok, msg = send_motor_cmd("right")
             status_box.success(f"Sent RIGHT — {msg}" if ok else f"Error: {msg}")
         c3, c4 = st.columns(2)
         if c3.button("↔️ Both", key="both_btn"):
-            ok, msg = send_motor_direct_tcp("both")
+            ok, msg = send_motor_cmd("both")
             status_box.info(f"Sent BOTH — {msg}" if ok else f"Error: {msg}")
         if c4.button("⏹️ Stop", key="stop_btn"):
-            ok, msg = send_motor_direct_tcp("stop")
+            ok, msg = send_motor_cmd("stop")
             status_box.warning(f"Sent STOP — {msg}" if ok else f"Error: {msg}")
 
 # -------- LOCATION TAB --------
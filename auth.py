@@ -0,0 +1,200 @@
+"""
+auth.py
+
+Keeps login/signup load away from the vision loop in server.py:
+
+- PasswordHasher runs Werkzeug's deliberately slow KDFs (scrypt / pbkdf2) in a small process
+  pool at lowered CPU priority. A semaphore caps how many hashes can be running or queued.
+  A request that cannot get a slot within queue_timeout fails with HasherBusy (HTTP 503)
+  instead of piling up. If a worker dies (OOM kill, crash), the requests it breaks get
+  HasherBusy too, and the next one starts a fresh pool. server.py starts the pool at boot,
+  before the vision pipeline, so worker startup never competes with inference.
+- RateLimiter is a per-key token bucket (per username on /login), so one account cannot be
+  hammered (HTTP 429).
+- SessionTokens issues the signed, timestamped token /login returns. Later requests present it
+  as "Authorization: Bearer <token>" and it is checked from the signature alone, with no
+  database lookup and no server-side session table.
+"""
+import multiprocessing as mp
+import os
+import secrets
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.security import check_password_hash, generate_password_hash
+
+HASH_WORKERS = 2          # processes; leaves the remaining cores to capture + inference
+HASH_MAX_PENDING = 8      # hashes running or waiting for a worker
+HASH_QUEUE_TIMEOUT = 2.0  # seconds a request may wait for a slot before 503
+HASH_WORKER_NICE = 10
+
+LOGIN_RATE_BURST = 5      # attempts per username...
+LOGIN_RATE_PER_MIN = 10   # ...refilled at this rate
+RATE_LIMITER_MAX_KEYS = 10000
+
+SESSION_TOKEN_MAX_AGE = 12 * 3600   # seconds
+SESSION_TOKEN_SALT = "horcrux-session"
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _lower_priority(nice):
+    try:
+        os.nice(nice)
+    except (AttributeError, OSError):
+        pass
+
+
+def _mp_context():
+    # Not fork: the server process runs camera/ORT/socket threads. Under spawn every worker
+    # imports the parent's main module (server.py, so cv2, onnxruntime and Flask) from scratch.
+    # With forkserver the fork server imports it once and the workers share it copy-on-write.
+    # Preloading '__main__' is a no-op (the fork server is never handed the main path), so the
+    # main script is preloaded under its module name; each worker then only re-runs its body.
+    if 'forkserver' not in mp.get_all_start_methods():
+        return mp.get_context('spawn')
+    ctx = mp.get_context('forkserver')
+    main_file = getattr(sys.modules['__main__'], '__file__', None)
+    preload = ['werkzeug.security']
+    if main_file:
+        preload.append(os.path.splitext(os.path.basename(main_file))[0])
+    ctx.set_forkserver_preload(preload)
+    return ctx
+
+
+class PasswordHasher:
+    def __init__(self, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING, queue_timeout=HASH_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.completed = 0
+
+    def _pool(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=_mp_context(),
+                                                    initializer=_lower_priority, initargs=(HASH_WORKER_NICE,))
+            return self.executor
+
+    def start(self):
+        """Start every worker process now rather than on the first /signup or /login."""
+        pool = self._pool()
+        for fut in [pool.submit(os.getpid) for _ in range(self.workers)]:
+            fut.result()
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            with self.lock:
+                self.rejected += 1
+            raise HasherBusy("password hashing is saturated")
+        with self.lock:
+            self.pending += 1
+        pool = self._pool()
+        try:
+            result = pool.submit(fn, *args).result()
+            with self.lock:
+                self.completed += 1
+            return result
+        except BrokenProcessPool:
+            self._discard(pool)
+            raise HasherBusy("password hashing pool died, restarting")
+        except CancelledError:
+            # close() during shutdown cancels whatever was still queued
+            raise HasherBusy("password hashing is shutting down")
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password)
+
+    def check(self, pw_hash, password):
+        return self._run(check_password_hash, pw_hash, password)
+
+    def _discard(self, pool):
+        # several requests may see the same broken pool; only the first replaces it
+        with self.lock:
+            if self.executor is not pool:
+                return
+            self.executor = None
+            self.restarts += 1
+        print("[auth] hash worker died, pool will be restarted")
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self.lock:
+            return {'pending': self.pending, 'completed': self.completed, 'rejected': self.rejected,
+                    'restarts': self.restarts}
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RateLimiter:
+    """Token bucket per key: `burst` attempts at once, refilled at `per_min` per minute."""
+    def __init__(self, burst=LOGIN_RATE_BURST, per_min=LOGIN_RATE_PER_MIN, max_keys=RATE_LIMITER_MAX_KEYS):
+        self.burst = float(burst)
+        self.rate = per_min / 60.0
+        self.max_keys = max_keys
+        self.buckets = {}   # key -> (tokens, last update)
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        """Takes one token for key. Returns (allowed, seconds until the next token)."""
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1.0:
+                self.buckets[key] = (tokens, now)
+                return False, (1.0 - tokens) / self.rate
+            self.buckets[key] = (tokens - 1.0, now)
+            if len(self.buckets) > self.max_keys:
+                self._prune(now)
+            return True, 0.0
+
+    def _prune(self, now):
+        # a bucket that has refilled completely carries no state worth keeping
+        full = [k for k, (tokens, last) in self.buckets.items() if tokens + (now - last) * self.rate >= self.burst]
+        for k in full:
+            del self.buckets[k]
+
+
+class SessionTokens:
+    """
+    Stateless session tokens. The secret comes from SESSION_SECRET; without it a random one is
+    made per process, so tokens stop verifying when the server restarts.
+    """
+    def __init__(self, secret=None, max_age=SESSION_TOKEN_MAX_AGE, salt=SESSION_TOKEN_SALT):
+        secret = secret or os.environ.get("SESSION_SECRET")
+        self.ephemeral = not secret
+        if self.ephemeral:
+            secret = secrets.token_hex(32)
+        self.max_age = max_age
+        self.serializer = URLSafeTimedSerializer(secret, salt=salt)
+
+    def issue(self, username):
+        return self.serializer.dumps({'u': username})
+
+    def verify(self, token):
+        """Username the token was issued for, or None if it is forged, malformed or expired."""
+        try:
+            data = self.serializer.loads(token, max_age=self.max_age)
+        except BadSignature:   # SignatureExpired is a subclass
+            return None
+        return data.get('u') if isinstance(data, dict) else None
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+bench_login.py
+
+Measures how much /login load costs the depth loop of a running server.py: samples
+pipeline.inference_fps from /status while idle, then again while worker threads hammer /login,
+and prints both along with the login status codes, latencies and how many password hashes
+the server actually ran (from /status auth.completed).
+
+   python bench_login.py --base http://localhost:9999 --threads 16 --duration 20
+
+/login is rate limited per username (5 attempts, then 10/min), so a thread that kept logging
+in as one user would mostly get 429s answered before any hashing. Instead --users accounts
+(<user>0, <user>1, ...) are created through /signup and every thread cycles through its
+share of them; the default is enough to keep 2 hash workers busy for a few minutes. Use
+--same-user to exercise the rate limit itself.
+"""
+import argparse
+import collections
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def sample_fps(base, duration, interval=0.5):
+    samples = []
+    end = time.time() + duration
+    with requests.Session() as s:
+        while time.time() < end:
+            try:
+                st = s.get(f"{base}/status", timeout=2.0).json()
+                samples.append(float(st['pipeline']['inference_fps']))
+            except Exception as e:
+                print("[bench] /status failed:", e)
+            time.sleep(interval)
+    return samples
+
+
+def hashes_completed(base):
+    try:
+        return int(requests.get(f"{base}/status", timeout=2.0).json()['auth']['completed'])
+    except Exception:
+        return None
+
+
+def ensure_user(base, username, password):
+    # signup hashes too, so it can be turned away with 503 while the pool is saturated
+    for _ in range(20):
+        r = requests.post(f"{base}/signup", json={'username': username, 'password': password, 'full_name': 'bench'}, timeout=30)
+        if r.status_code in (200, 409):
+            return
+        if r.status_code != 503:
+            break
+        time.sleep(float(r.headers.get('Retry-After', 1)))
+    raise SystemExit(f"signup for {username} failed: {r.status_code} {r.text}")
+
+
+def hammer(base, users, password, stop, codes, latencies, lock):
+    i = 0
+    with requests.Session() as s:
+        while not stop.is_set():
+            username = users[i % len(users)]; i += 1
+            t0 = time.perf_counter()
+            try:
+                code = s.post(f"{base}/login", json={'username': username, 'password': password}, timeout=30).status_code
+            except Exception:
+                code = 'error'
+            ms = (time.perf_counter() - t0) * 1000.0
+            with lock:
+                codes[code] += 1
+                latencies.append(ms)
+
+
+def describe(samples):
+    if not samples:
+        return "no samples"
+    return f"mean {statistics.mean(samples):.1f}  min {min(samples):.1f}  (n={len(samples)})"
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="depth FPS under /login load")
+    ap.add_argument('--base', default="http://localhost:9999")
+    ap.add_argument('--threads', type=int, default=16)
+    ap.add_argument('--duration', type=float, default=20.0)
+    ap.add_argument('--baseline', type=float, default=10.0, help="seconds of idle FPS sampling first")
+    ap.add_argument('--user', default="bench")
+    ap.add_argument('--users', type=int, default=200, help="accounts the threads cycle through")
+    ap.add_argument('--password', default="bench-password")
+    ap.add_argument('--same-user', action='store_true', help="all threads use one account (tests the rate limit)")
+    args = ap.parse_args(argv)
+
+    users = [args.user] if args.same_user else [f"{args.user}{i}" for i in range(max(args.users, args.threads))]
+    print(f"[bench] preparing {len(users)} user(s)")
+    with ThreadPoolExecutor(8) as ex:
+        list(ex.map(lambda u: ensure_user(args.base, u, args.password), users))
+
+    print(f"[bench] baseline for {args.baseline:.0f}s")
+    baseline = sample_fps(args.base, args.baseline)
+
+    stop = threading.Event()
+    codes = collections.Counter(); latencies = []; lock = threading.Lock()
+    workers = [threading.Thread(target=hammer, daemon=True,
+                                args=(args.base, users[i::args.threads] or users, args.password, stop, codes, latencies, lock))
+               for i in range(args.threads)]
+    print(f"[bench] {args.threads} threads on /login for {args.duration:.0f}s")
+    hashed0 = hashes_completed(args.base)
+    t0 = time.time()
+    for w in workers:
+        w.start()
+    loaded = sample_fps(args.base, args.duration)
+    stop.set()
+    for w in workers:
+        w.join(timeout=30)
+    elapsed = time.time() - t0
+    hashed1 = hashes_completed(args.base)
+
+    print()
+    print("inference fps idle:       ", describe(baseline))
+    print("inference fps under load: ", describe(loaded))
+    total = sum(codes.values())
+    print(f"/login: {total} requests, {total / elapsed:.1f}/s, status codes {dict(codes)}")
+    if hashed0 is not None and hashed1 is not None:
+        print(f"password hashes run: {hashed1 - hashed0} ({(hashed1 - hashed0) / elapsed:.1f}/s)")
+    if latencies:
+        lat = sorted(latencies)
+        print(f"/login latency ms: p50 {lat[len(lat) // 2]:.0f}  p95 {lat[int(len(lat) * 0.95)]:.0f}  max {lat[-1]:.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
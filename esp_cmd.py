@@ -0,0 +1,229 @@
+"""
+esp_cmd.py
+
+Long-lived command channel to an ESP's motor command port (8001), used by server.py's
+/esp/cmd proxy. The Streamlit UI (app.py) sends its motor commands through that proxy, so
+each ESP has exactly one client connection.
+
+Commands are newline-terminated text ("left", "right", "both", "stop"). The channel keeps
+one TCP connection open and reconnects with backoff when it drops. Commands are written as
+soon as they are queued, without waiting for the previous reply (pipelining). Replies are
+matched to commands in FIFO order, which is how the ESP answers them. A command that gets no
+reply within reply_timeout still counts as sent, as with the old one-connection-per-command
+helpers.
+
+A command is never written after its caller was told it failed: send() cancels it on timeout
+and the writer skips cancelled commands. While the ESP is unreachable, commands fail at once
+instead of waiting for the next reconnect attempt.
+
+   channel = get_channel("10.87.74.192", 8001)
+   ok, resp = channel.send("left")
+"""
+import collections
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+CONNECT_TIMEOUT = 1.0
+REPLY_TIMEOUT = 0.5
+MAX_QUEUE = 16            # commands waiting to be written; more are rejected with "queue_full"
+RECONNECT_MAX_DELAY = 5.0
+# a late reply is still matched to its (already answered) command for this long, so one slow
+# reply cannot shift every following reply onto the wrong command
+LATE_REPLY_WINDOW = 2.0
+
+
+class EspCommandChannel:
+    def __init__(self, host, port, connect_timeout=CONNECT_TIMEOUT, reply_timeout=REPLY_TIMEOUT,
+                 max_queue=MAX_QUEUE):
+        self.addr = (host, port)
+        self.connect_timeout = connect_timeout
+        self.reply_timeout = reply_timeout
+        self.queue = queue.Queue(max_queue)
+        self.inflight = collections.deque()   # [future, reply deadline], oldest first
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.down_reason = None               # set while reconnecting after a failed connect
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"esp-cmd-{host}:{port}")
+        self.thread.start()
+
+    # ---------------- API ----------------
+    def submit(self, cmd):
+        """Queue cmd without waiting. Returns a Future resolving to (ok, resp_or_error)."""
+        fut = Future()
+        text = (cmd or "").strip()
+        if not text:
+            fut.set_result((False, "empty cmd"))
+            return fut
+        reason = self.down_reason
+        if reason is not None:
+            fut.set_result((False, reason))
+            return fut
+        try:
+            self.queue.put_nowait(((text + "\n").encode('ascii', 'ignore'), fut))
+        except queue.Full:
+            fut.set_result((False, "queue_full"))
+        return fut
+
+    def send(self, cmd, timeout=None):
+        """Send cmd and wait for its reply. Returns (ok, resp_or_error); resp is None without a reply."""
+        fut = self.submit(cmd)
+        if timeout is None:
+            timeout = self.connect_timeout + self.reply_timeout + 1.0
+        try:
+            return fut.result(timeout)
+        except FutureTimeout:
+            if fut.cancel():
+                return False, "timeout"
+            # already written: report what the ESP made of it rather than a failure
+            return fut.result(self.reply_timeout + 1.0)
+
+    def stats(self):
+        with self.lock:
+            inflight = len(self.inflight)
+        return {'connected': self.connected.is_set(), 'queued': self.queue.qsize(), 'inflight': inflight}
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join(timeout=2.0)
+
+    # ---------------- I/O ----------------
+    def _run(self):
+        delay = 0.5
+        reported = False
+        while not self.stop_event.is_set():
+            try:
+                sock = socket.create_connection(self.addr, timeout=self.connect_timeout)
+            except OSError as e:
+                if not reported:
+                    print(f"[EspCmd] connect to {self.addr[0]}:{self.addr[1]} failed:", e)
+                    reported = True
+                # fail what is waiting now, and anything submitted during the backoff, instead
+                # of letting button presses pile up for later
+                self.down_reason = f"connect_failed: {e}"
+                self._fail_queued(self.down_reason)
+                deadline = time.monotonic() + delay
+                while not self.stop_event.wait(min(0.05, max(0.0, deadline - time.monotonic()))):
+                    self._fail_queued(self.down_reason)
+                    if time.monotonic() >= deadline:
+                        break
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            self.down_reason = None
+            print(f"[EspCmd] connected to {self.addr[0]}:{self.addr[1]}")
+            delay = 0.5
+            reported = False
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+            broken = threading.Event()
+            reader = threading.Thread(target=self._read_loop, args=(sock, broken), daemon=True)
+            self.connected.set()
+            reader.start()
+            try:
+                self._write_loop(sock, broken)
+            finally:
+                self.connected.clear()
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                sock.close()
+                reader.join(timeout=1.0)
+                self._finish_inflight()
+                if not self.stop_event.is_set():
+                    print("[EspCmd] connection lost, reconnecting")
+        self._fail_queued("closed")
+
+    def _write_loop(self, sock, broken):
+        while not (self.stop_event.is_set() or broken.is_set()):
+            self._expire_inflight()
+            try:
+                data, fut = self.queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            # from here on send() can no longer cancel it; skip it if it already did
+            if not fut.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.inflight.append([fut, time.monotonic() + self.reply_timeout])
+            try:
+                sock.sendall(data)
+            except OSError as e:
+                with self.lock:
+                    self.inflight.pop()
+                fut.set_result((False, f"send_failed: {e}"))
+                return
+
+    def _read_loop(self, sock, broken):
+        sock.settimeout(0.05)
+        buf = b''
+        try:
+            while not broken.is_set():
+                try:
+                    data = sock.recv(512)
+                except socket.timeout:
+                    # firmware that answers without a newline: a quiet line counts as a reply
+                    if buf:
+                        self._on_reply(buf)
+                        buf = b''
+                    continue
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    self._on_reply(line)
+        except OSError:
+            pass
+        finally:
+            broken.set()
+
+    def _on_reply(self, raw):
+        with self.lock:
+            entry = self.inflight.popleft() if self.inflight else None
+        if entry is not None and not entry[0].done():
+            entry[0].set_result((True, raw.decode('ascii', errors='ignore').strip()))
+
+    def _expire_inflight(self):
+        now = time.monotonic()
+        with self.lock:
+            for entry in self.inflight:
+                if now >= entry[1] and not entry[0].done():
+                    entry[0].set_result((True, None))
+            while self.inflight and now >= self.inflight[0][1] + LATE_REPLY_WINDOW:
+                self.inflight.popleft()
+
+    def _finish_inflight(self):
+        with self.lock:
+            entries = list(self.inflight)
+            self.inflight.clear()
+        for fut, _ in entries:
+            if not fut.done():
+                fut.set_result((True, None))
+
+    def _fail_queued(self, reason):
+        while True:
+            try:
+                _, fut = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if fut.set_running_or_notify_cancel():
+                fut.set_result((False, reason))
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def get_channel(host, port, **kwargs):
+    """Process-wide channel per ESP address, created (and connected) on first use."""
+    with _channels_lock:
+        channel = _channels.get((host, port))
+        if channel is None:
+            channel = _channels[(host, port)] = EspCommandChannel(host, port, **kwargs)
+        return channel
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+quantize_midas.py
+
+Builds and checks reduced-precision variants of the MiDaS depth model used by server.py.
+
+   python quantize_midas.py dynamic
+   python quantize_midas.py static --calib recordings/walk.mp4 --frames 200
+   python quantize_midas.py fp16
+   python quantize_midas.py compare --variant int8_static --clip recordings/reference.mp4
+
+Output paths default to the entries in server.MODEL_VARIANTS, so the server picks the files up
+with MODEL_VARIANT=<name> (or MODEL_VARIANT=auto, which also reads the drift report written
+by `compare`).
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+import server
+
+try:
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat,
+                                          QuantType, quantize_dynamic, quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    QUANT_AVAILABLE = True
+except Exception:
+    CalibrationDataReader = object
+    QUANT_AVAILABLE = False
+
+try:
+    from onnxconverter_common import float16
+    FP16_AVAILABLE = True
+except Exception:
+    FP16_AVAILABLE = False
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+# ---------------- FRAMES ----------------
+def iter_frames(source, limit=200, every=5):
+    """
+    Yields oriented BGR frames from a video file or a directory of images, taking every
+    `every`-th video frame so calibration covers the whole recording.
+    """
+    if os.path.isdir(source):
+        paths = sorted(p for p in glob.glob(os.path.join(source, '*')) if p.lower().endswith(IMAGE_EXTS))
+        for path in paths[:limit]:
+            frame = cv2.imread(path)
+            if frame is not None:
+                yield server.orient_frame(frame)
+        return
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise SystemExit(f"Could not open {source}")
+    count = 0; idx = 0
+    try:
+        while count < limit:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if idx % every == 0:
+                yield server.orient_frame(frame)
+                count += 1
+            idx += 1
+    finally:
+        cap.release()
+
+
+def model_input(model_path):
+    sess = ort.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+    return sess.get_inputs()[0].name, server.infer_model_input_size(sess)
+
+
+class FrameCalibrationReader(CalibrationDataReader):
+    """Feeds recorded frames through the server's own preprocessing to the static quantizer."""
+
+    def __init__(self, input_name, frames, target_size):
+        pre = server.DepthPreprocessor(target_size)
+        # DepthPreprocessor reuses its tensor, so keep a copy per frame
+        self.batches = [{input_name: pre(f).copy()} for f in frames]
+        self.it = iter(self.batches)
+
+    def get_next(self):
+        return next(self.it, None)
+
+    def rewind(self):
+        self.it = iter(self.batches)
+
+
+# ---------------- BUILD ----------------
+def require_quant():
+    if not QUANT_AVAILABLE:
+        raise SystemExit("onnxruntime.quantization needs the 'onnx' package: pip install onnx")
+
+
+def preprocess_for_quant(model_path):
+    """Shape inference + graph cleanup recommended before quantizing; falls back to the raw model."""
+    out_path = model_path.replace('.onnx', '.quant-prep.onnx')
+    try:
+        quant_pre_process(model_path, out_path, skip_symbolic_shape=True)
+        return out_path
+    except Exception as e:
+        print("[quantize] pre-processing skipped:", e)
+        return model_path
+
+
+def drop_prep(src, model_path):
+    if src != model_path:
+        try: os.remove(src)
+        except OSError: pass
+
+
+def build_dynamic(model_path, out_path):
+    require_quant()
+    src = preprocess_for_quant(model_path)
+    try:
+        quantize_dynamic(src, out_path, weight_type=QuantType.QUInt8, per_channel=False)
+    finally:
+        drop_prep(src, model_path)
+    print("[quantize] wrote", out_path)
+
+
+def build_static(model_path, out_path, calib, frames, every):
+    require_quant()
+    input_name, target_size = model_input(model_path)
+    calib_frames = list(iter_frames(calib, limit=frames, every=every))
+    if not calib_frames:
+        raise SystemExit(f"No calibration frames found in {calib}")
+    print(f"[quantize] calibrating on {len(calib_frames)} frames at {target_size}px")
+    reader = FrameCalibrationReader(input_name, calib_frames, target_size)
+    src = preprocess_for_quant(model_path)
+    try:
+        quantize_static(src, out_path, reader,
+                        quant_format=QuantFormat.QDQ,
+                        per_channel=True,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.Percentile)
+    finally:
+        drop_prep(src, model_path)
+    print("[quantize] wrote", out_path)
+
+
+def build_fp16(model_path, out_path):
+    if not FP16_AVAILABLE:
+        raise SystemExit("fp16 conversion needs onnxconverter-common: pip install onnxconverter-common")
+    model = onnx.load(model_path)
+    # keep float32 inputs/outputs so server.py feeds and reads the model unchanged
+    model16 = float16.convert_float_to_float16(model, keep_io_types=True)
+    onnx.save(model16, out_path)
+    print("[quantize] wrote", out_path)
+
+
+# ---------------- DRIFT ----------------
+def timed_run(sess, input_name, output_name, inp):
+    t0 = time.perf_counter()
+    pred = sess.run([output_name], {input_name: inp})[0]
+    return pred, (time.perf_counter() - t0) * 1000.0
+
+
+def compare(ref_path, variant_path, clip, frames, every):
+    """
+    Runs fp32 and the variant on the same reference frames and reports depth error after the
+    server's normalization, plus how often the obstacle tuple matches. Written next to the
+    variant as <model>.drift.json, which server.resolve_model_variant reads for "auto".
+    """
+    ref = ort.InferenceSession(ref_path, providers=['CPUExecutionProvider'])
+    var = ort.InferenceSession(variant_path, providers=['CPUExecutionProvider'])
+    input_name = ref.get_inputs()[0].name
+    target_size = server.infer_model_input_size(ref)
+    pre = server.DepthPreprocessor(target_size)
+    post_ref = server.DepthPostprocessor(); post_var = server.DepthPostprocessor()
+
+    abs_err = []; sq_err = []; p99 = []; agree = 0; n = 0
+    ref_ms = []; var_ms = []
+    for frame in iter_frames(clip, limit=frames, every=every):
+        h0, w0 = frame.shape[:2]
+        inp = pre(frame)
+        pred_ref, t_ref = timed_run(ref, input_name, ref.get_outputs()[0].name, inp)
+        pred_var, t_var = timed_run(var, var.get_inputs()[0].name, var.get_outputs()[0].name, inp)
+        d_ref = post_ref(pred_ref, invert=server.INVERT_DEPTH)
+        d_var = post_var(pred_var, invert=server.INVERT_DEPTH)
+        diff = np.abs(d_ref - d_var)
+        abs_err.append(float(diff.mean()))
+        sq_err.append(float((diff * diff).mean()))
+        p99.append(float(np.percentile(diff, 99)))
+        tpl_ref, _ = server.detect_close_panes(d_ref, out_size=(w0, h0))
+        tpl_var, _ = server.detect_close_panes(d_var, out_size=(w0, h0))
+        agree += int(tpl_ref == tpl_var)
+        ref_ms.append(t_ref); var_ms.append(t_var)
+        n += 1
+    if not n:
+        raise SystemExit(f"No frames read from {clip}")
+
+    report = {
+        'reference': ref_path,
+        'variant': variant_path,
+        'clip': clip,
+        'frames': n,
+        'input_size': target_size,
+        'mean_abs_err': float(np.mean(abs_err)),
+        'rmse': float(np.sqrt(np.mean(sq_err))),
+        'p99_abs_err': float(np.mean(p99)),
+        'pane_agreement': agree / n,
+        # first runs include allocator warm-up, so use medians
+        'fp32_ms': float(np.median(ref_ms)),
+        'variant_ms': float(np.median(var_ms)),
+        'speedup': float(np.median(ref_ms) / max(np.median(var_ms), 1e-6)),
+        'created': time.time(),
+    }
+    with open(server.drift_report_path(variant_path), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    return report
+
+
+# ---------------- CLI ----------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Build and check quantized MiDaS variants for server.py")
+    sub = ap.add_subparsers(dest='cmd', required=True)
+
+    p = sub.add_parser('dynamic', help="INT8 dynamic quantization (weights only, no calibration)")
+    p.add_argument('--model', default=server.MODEL_VARIANTS['fp32'])
+    p.add_argument('--out', default=server.MODEL_VARIANTS['int8_dynamic'])
+
+    p = sub.add_parser('static', help="INT8 static QDQ quantization calibrated on recorded frames")
+    p.add_argument('--model', default=server.MODEL_VARIANTS['fp32'])
+    p.add_argument('--out', default=server.MODEL_VARIANTS['int8_static'])
+    p.add_argument('--calib', required=True, help="video file or directory of images")
+    p.add_argument('--frames', type=int, default=200)
+    p.add_argument('--every', type=int, default=5)
+
+    p = sub.add_parser('fp16', help="FP16 weights with float32 I/O (GPU/CoreML providers)")
+    p.add_argument('--model', default=server.MODEL_VARIANTS['fp32'])
+    p.add_argument('--out', default=server.MODEL_VARIANTS['fp16'])
+
+    p = sub.add_parser('compare', help="measure drift of a variant against fp32 on a reference clip")
+    p.add_argument('--model', default=server.MODEL_VARIANTS['fp32'])
+    p.add_argument('--variant', required=True, help="variant name from server.MODEL_VARIANTS or a path")
+    p.add_argument('--clip', required=True, help="video file or directory of images")
+    p.add_argument('--frames', type=int, default=100)
+    p.add_argument('--every', type=int, default=3)
+
+    args = ap.parse_args(argv)
+    if args.cmd == 'dynamic':
+        build_dynamic(args.model, args.out)
+    elif args.cmd == 'static':
+        build_static(args.model, args.out, args.calib, args.frames, args.every)
+    elif args.cmd == 'fp16':
+        build_fp16(args.model, args.out)
+    elif args.cmd == 'compare':
+        variant_path = server.MODEL_VARIANTS.get(args.variant, args.variant)
+        compare(args.model, variant_path, args.clip, args.frames, args.every)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
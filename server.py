@@ -4,10 +4,10 @@ merged_main.py
 
 
 - Integrates MiDaS ONNX depth + pane detection loop
-- Starts ESPServer (TCP) and AppServer (TCP)
+- Starts the DeviceGateway (asyncio TCP) for ESP units and app clients
 - Exposes Flask HTTP endpoints used by Streamlit:
    - /video, /location, /status
-   - /signup, /login, /profile/<username>
+   - /signup, /login (returns a session token), /profile/<username>
    - /set_location
    - /esp and /esp/cmd  <-- proxy endpoints to forward motor commands to ESP device
 """
@@ -19,14 +19,22 @@ import sys
 import socket
 import threading
 import json
+import asyncio
 import struct
+import functools
+import collections
+import zlib
+import multiprocessing as mp
+from multiprocessing import shared_memory
 from flask import Flask, Response, request, jsonify
 import logging
-import sqlite3
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_cors import CORS
 
+import auth
+import esp_cmd
+import user_store
+
 
 try:
    from gps3 import gps3
@@ -49,15 +57,96 @@ except Exception:
 GPS_SERIAL_DEVICE = "/dev/ttyUSB0"
 GPS_BAUDRATE = 9600
 GPS_POLL_INTERVAL = 2.0
+GPS_FIX_MAX_AGE = 5.0          # a precise fix older than this no longer counts
+GPS_RECONNECT_MAX_DELAY = 60.0  # backoff cap when gpsd / the serial port is missing
+IP_LOCATION_INTERVAL = 60.0    # how often the IP geolocation fallback may hit the network
 
 
 MODEL_PATH = "models/midas_v21_384.onnx"
+# Which model file to load: one of MODEL_VARIANTS, or "auto" to take the first variant in
+# AUTO_VARIANT_ORDER whose drift report (written by quantize_midas.py compare) is good enough.
+# fp16 only pays off on GPU/CoreML providers; the CPU provider has few fp16 kernels.
+MODEL_VARIANT = os.environ.get("MODEL_VARIANT", "fp32")
+MODEL_VARIANTS = {
+   "fp32": MODEL_PATH,
+   "int8_static": "models/midas_v21_384.int8-static.onnx",
+   "int8_dynamic": "models/midas_v21_384.int8-dynamic.onnx",
+   "fp16": "models/midas_v21_384.fp16.onnx",
+}
+AUTO_VARIANT_ORDER = ("int8_static", "int8_dynamic", "fp32")
+VARIANT_MIN_PANE_AGREEMENT = 0.95
 VIDEO_SOURCE = 0
+# Several cameras (e.g. chest + head) are captured concurrently and inferred as one batch when
+# the model has a dynamic batch dimension. Camera 0 is the primary: /video, the app stream.
+VIDEO_SOURCES = [VIDEO_SOURCE]
 TARGET_FPS = 30.0
 INVERT_DEPTH = False
 USE_CUBIC_RESIZE = True
 
 
+# Adaptive inference resolution (models with dynamic H/W inputs only). The size is chosen per
+# frame so the smoothed inference time stays under the budget; when no obstacle is near the
+# budget is scaled down, trading depth detail nobody needs for CPU and battery.
+ADAPTIVE_RESOLUTION = True
+ADAPTIVE_SIZES = (192, 256, 384)      # multiples of 32, as MiDaS requires
+ADAPTIVE_BUDGET_MS = 120.0
+ADAPTIVE_CLEAR_BUDGET_SCALE = 0.6
+ADAPTIVE_HYSTERESIS = 0.2             # only step up if the predicted time is this far under budget
+ADAPTIVE_HOLD_FRAMES = 15             # minimum frames between size changes
+
+
+# Motion-gated inference: while the view barely changes the previous depth map is reused.
+MOTION_GATING = True
+MOTION_THUMB_SIZE = 64        # side of the grayscale thumbnail the motion score is computed on
+MOTION_THRESHOLD = 4.0        # mean abs grey-level change (0-255) vs the last inferred frame
+MOTION_REFRESH_FRAMES = 10    # run inference at least every N frames regardless
+
+
+# Depth stabilization: normalize against running (EMA) percentile estimates instead of each
+# frame's own min/max, and low-pass the normalized map over time, so one reflection cannot
+# rescale the whole map and flip pane bits from frame to frame.
+DEPTH_STABILIZE = True
+DEPTH_NORM_PERCENTILES = (2.0, 98.0)
+DEPTH_SAMPLE_STRIDE = 4       # percentiles are estimated on every Nth row/column of the native map
+DEPTH_SCALE_ALPHA = 0.1       # EMA rate of the low/high scale estimates
+DEPTH_TEMPORAL_ALPHA = 0.5    # weight of the newest frame in the filtered depth map
+
+
+# ONNX Runtime session profile (see ORT_PROFILES). "default" keeps the old behaviour:
+# Apple GPU providers when present, otherwise a plain CPU session.
+ORT_PROFILE = os.environ.get("ORT_PROFILE", "default")
+ORT_PROFILES = {
+   "default": {
+       "providers": ['MPSExecutionProvider', 'CoreMLExecutionProvider', 'MetalExecutionProvider', 'CPUExecutionProvider'],
+   },
+   # Linux ARM/x86 boxes: all cores on one op, full graph optimization, optimized model cached on disk
+   "linux_cpu": {
+       "providers": ['OpenVINOExecutionProvider', 'XnnpackExecutionProvider', 'CPUExecutionProvider'],
+       "intra_op_threads": 0,          # 0 = one per core
+       "inter_op_threads": 1,
+       "execution_mode": "sequential",
+       "graph_optimization": "all",
+       "optimized_model_cache": "models/ort_cache",
+       "cpu_mem_arena": True,
+       "mem_pattern": True,
+       "allow_spinning": True,
+   },
+   # Pi-class wearables: leave cores for capture/publish and don't spin-wait between frames
+   "low_power": {
+       "providers": ['XnnpackExecutionProvider', 'CPUExecutionProvider'],
+       "provider_options": {'XnnpackExecutionProvider': {'intra_op_num_threads': 2}},
+       "intra_op_threads": 2,
+       "inter_op_threads": 1,
+       "execution_mode": "sequential",
+       "graph_optimization": "extended",
+       "optimized_model_cache": "models/ort_cache",
+       "cpu_mem_arena": False,
+       "mem_pattern": True,
+       "allow_spinning": False,
+   },
+}
+
+
 ESP_HOST = ""
 ESP_PORT = 5001
 APP_HOST = ""
@@ -70,13 +159,46 @@ FLASK_PORT = 9999
 
 CLOSE_THRESH = 0.70
 MIN_BLOB_AREA = 200
+# Panes across the view (3, 5 or 7). Besides the 0/1 tuple every pane gets a graded summary,
+# see pane_summary: the ESP binary protocol turns 'near' into a vibration intensity.
+PANE_COUNT = 3
+PANE_NEAR_PERCENTILE = 95.0     # per column, so a few noisy pixels do not make a pane "near"
+PANE_INTENSITY_FLOOR = 0.5      # normalized depth where the intensity starts to rise from 0
 
 
 MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
 STD  = np.array([0.229, 0.224, 0.225], dtype=np.float32)
 
 
-ESP_SEND_INTERVAL = 0.15
+ESP_SEND_INTERVAL = 0.15   # text protocol: the tuple is resent this often, changed or not
+# ESP obstacle protocol: "text" sends "(0, 1, 0)\n" lines as before; "binary" sends the framed
+# format built by encode_esp_frame, only on change plus a heartbeat. This is the default for
+# new connections; a unit can pick its own by sending "BIN1\n" or "TXT\n" after connecting.
+ESP_PROTOCOL = "text"
+ESP_PROTOCOL_VERSION = 1
+ESP_HEARTBEAT_INTERVAL = 1.0     # binary: resend an unchanged state this often
+ESP_MIN_CHANGE_INTERVAL = 0.05   # binary: changes closer together than this are coalesced
+ESP_INTENSITY_LEVELS = 8         # pane intensities are quantized so depth noise is not a "change"
+# Gateway send queues, per client: frames and obstacle tuples are latest-wins (one pending
+# message, a newer one replaces it); LOC messages are queued in order and never dropped. A
+# client with this many LOC messages still unsent is treated as dead and disconnected.
+GATEWAY_RELIABLE_QUEUE = 64
+
+
+# frames older than this when inference picks them up are dropped instead of inferred
+MAX_FRAME_AGE = 0.25
+FRAME_RING_SLOTS = 8   # per camera; a captured frame stays readable until this many newer ones arrive
+JPEG_QUALITY = 80
+MJPEG_MAX_CLIENTS = 8
+MJPEG_KEEPALIVE = 5.0  # resend the current frame this often when nothing new is published
+
+
+# Run capture + inference (and overlay/JPEG encoding) in a separate worker process, so Flask
+# and the TCP servers cannot hold the GIL against the vision loop. Encoded frames come back
+# through a shared-memory ring; tuples, stats and frame notifications through a pipe.
+VISION_WORKER = os.environ.get("VISION_WORKER", "0") == "1"
+SHM_RING_SLOTS = 8
+SHM_SLOT_BYTES = 1 << 20       # one encoded JPEG per slot; larger frames are dropped
 
 
 DB_PATH = "users.db"
@@ -86,188 +208,407 @@ DB_PATH = "users.db"
 # Shared state
 # -----------------------
 frame_lock = threading.Lock()
-latest_frame_jpg = None
-latest_tuple = (0, 0, 0)
+latest_tuple = (0,) * PANE_COUNT  # merged over all cameras; this is what the ESP gets
+latest_camera_tuples = []         # per camera, index = position in VIDEO_SOURCES
+latest_panes = {}                 # merged pane_summary plus ESP intensities, see InferenceThread
 latest_location = {'lat': None, 'lon': None, 'host_ip': None, 'timestamp': None}
+session_info = {}
+device_gateway = None             # DeviceGateway, set by run_servers_and_loop
+pipeline_stats = {'capture_fps': [], 'inference_fps': 0.0, 'inference_ms': 0.0, 'dropped': 0, 'latency_ms': 0.0, 'input_size': None, 'reused': 0, 'motion': 0.0}
 
 
 # -----------------------
 # DB helpers
 # -----------------------
+user_db = user_store.UserStore(DB_PATH)
+# KDF work runs in a separate, bounded process pool so a login burst cannot starve inference
+password_hasher = auth.PasswordHasher()
+login_limiter = auth.RateLimiter()
+session_tokens = auth.SessionTokens()
+
+
 def init_db(db_path=DB_PATH):
-   need_create = not os.path.exists(db_path)
-   conn = sqlite3.connect(db_path)
-   try:
-       cur = conn.cursor()
-       cur.execute('''
-           CREATE TABLE IF NOT EXISTS users (
-               username TEXT PRIMARY KEY,
-               password_hash TEXT NOT NULL,
-               full_name TEXT,
-               age INTEGER,
-               condition TEXT,
-               caretaker_name TEXT,
-               caretaker_contact TEXT
-           )
-       ''')
-       conn.commit()
-   finally:
-       conn.close()
+   """Open the user store at db_path and bring its schema up to date."""
+   global user_db
+   if db_path != user_db.db_path:
+       user_db.close()
+       user_db = user_store.UserStore(db_path)
+   user_db.migrate()
 
 
 def db_insert_user(username, password, full_name="", age=None, condition="", caretaker_name="", caretaker_contact=""):
-   try:
-       conn = sqlite3.connect(DB_PATH)
-       cur = conn.cursor()
-       pw_hash = generate_password_hash(password)
-       cur.execute('''
-           INSERT INTO users(username, password_hash, full_name, age, condition, caretaker_name, caretaker_contact)
-           VALUES (?, ?, ?, ?, ?, ?, ?)
-       ''', (username, pw_hash, full_name, age, condition, caretaker_name, caretaker_contact))
-       conn.commit()
-       return True, None
-   except sqlite3.IntegrityError:
-       return False, "username exists"
-   except Exception as e:
-       return False, str(e)
-   finally:
-       try: conn.close()
-       except: pass
+   """Raises auth.HasherBusy when password hashing is saturated."""
+   pw_hash = password_hasher.hash(password)
+   return user_db.insert_user(username, pw_hash, full_name, age, condition, caretaker_name, caretaker_contact)
 
 
 def db_get_user(username):
-   conn = sqlite3.connect(DB_PATH)
-   conn.row_factory = sqlite3.Row
-   try:
-       cur = conn.cursor()
-       cur.execute('SELECT * FROM users WHERE username = ?', (username,))
-       row = cur.fetchone()
-       if not row:
-           return None
-       return dict(row)
-   finally:
-       conn.close()
+   return user_db.get_user(username)
 
 
-init_db()
+def db_get_profile(username):
+   """User row without the password hash."""
+   return user_db.get_profile(username)
 
 
 # -----------------------
-# GPS helpers (unchanged)
+# GPS helpers
 # -----------------------
-def read_gpsd_once(timeout=1.0):
-   if not GPSD_AVAILABLE:
-       return None
+def parse_nmea_fix(line):
+   """Returns (lat, lon, accuracy) for a GGA/RMC sentence carrying a valid fix, else None."""
    try:
-       gps_socket = gps3.GPSDSocket()
-       data_stream = gps3.DataStream()
-       gps_socket.connect()
-       gps_socket.watch()
-       t0 = time.time()
-       for new_data in gps_socket:
-           if new_data:
-               data_stream.unpack(new_data)
-               lat = getattr(data_stream.TPV, 'lat', None)
-               lon = getattr(data_stream.TPV, 'lon', None)
-               epx = getattr(data_stream.TPV, 'epx', None)
-               epy = getattr(data_stream.TPV, 'epy', None)
-               accuracy = None
-               try:
-                   if epx is not None and epy is not None:
-                       accuracy = max(float(epx), float(epy))
-               except:
-                   accuracy = None
-               if lat is not None and lon is not None:
-                   return float(lat), float(lon), accuracy
-           if time.time() - t0 > timeout:
-               break
-   except Exception as e:
-       print("[GPSD] error:", e)
+       msg = pynmea2.parse(line)
+   except pynmea2.ParseError:
+       return None
+   if isinstance(msg, pynmea2.types.talker.GGA) or msg.sentence_type == "GGA":
+       if getattr(msg, 'gps_qual', None) and int(msg.gps_qual) > 0:
+           lat = msg.latitude
+           lon = msg.longitude
+           hdop = getattr(msg, 'horizontal_dil', None)
+           accuracy = float(hdop) if hdop else None
+           return float(lat), float(lon), accuracy
+   if getattr(msg, 'sentence_type', None) == 'RMC':
+       if getattr(msg, 'status', None) == 'A':
+           lat = msg.latitude
+           lon = msg.longitude
+           return float(lat), float(lon), None
    return None
 
 
-def read_serial_gps_once(devpath=GPS_SERIAL_DEVICE, baud=GPS_BAUDRATE, timeout=1.0):
-   if not PYNMEA_AVAILABLE:
-       return None
-   try:
-       ser = serial.Serial(devpath, baudrate=baud, timeout=timeout)
-   except Exception as e:
-       return None
-   t0 = time.time()
-   try:
-       while True:
-           line = ser.readline().decode(errors='ignore').strip()
-           if not line:
-               if time.time() - t0 > timeout:
-                   break
-               continue
+# -----------------------
+# Location service
+# -----------------------
+class GpsdReader(threading.Thread):
+   """Holds one gpsd WATCH stream open and reports every TPV fix to on_fix."""
+   def __init__(self, on_fix, stop_event):
+       super().__init__(daemon=True)
+       self.on_fix = on_fix; self.stop_event = stop_event
+
+
+   def run(self):
+       delay = 1.0
+       while not self.stop_event.is_set():
+           gps_socket = gps3.GPSDSocket()
            try:
-               msg = pynmea2.parse(line)
-           except pynmea2.ParseError:
-               continue
-           if isinstance(msg, pynmea2.types.talker.GGA) or msg.sentence_type == "GGA":
-               if getattr(msg, 'gps_qual', None) and int(msg.gps_qual) > 0:
-                   lat = msg.latitude
-                   lon = msg.longitude
-                   hdop = getattr(msg, 'horizontal_dil', None)
-                   accuracy = float(hdop) if hdop is not None else None
-                   return float(lat), float(lon), accuracy
-           if getattr(msg, 'sentence_type', None) == 'RMC' or msg.sentence_type == 'RMC':
-               if getattr(msg, 'status', None) == 'A':
-                   lat = msg.latitude
-                   lon = msg.longitude
-                   return float(lat), float(lon), None
-           if time.time() - t0 > timeout:
-               break
-   finally:
+               gps_socket.connect()
+               gps_socket.streamSock.getpeername()  # connect() only logs failures, so check we are connected
+               gps_socket.watch()
+               print("[GPSD] watching gpsd stream")
+               delay = 1.0
+               # read the socket directly: GPSDSocket.next() wraps it in a new makefile() per call
+               # and throws away whatever that buffered beyond the first line (gpsd sends
+               # SKY+TPV in one write, so the TPV was the line being lost)
+               sock = gps_socket.streamSock
+               sock.settimeout(1.0)
+               buf = b''
+               while not self.stop_event.is_set():
+                   try:
+                       data = sock.recv(4096)
+                   except socket.timeout:
+                       continue
+                   if not data:
+                       raise ConnectionError("gpsd closed the stream")
+                   buf += data
+                   while b'\n' in buf:
+                       line, buf = buf.split(b'\n', 1)
+                       self.handle_line(line)
+           except Exception as e:
+               print("[GPSD] stream error:", e)
+           finally:
+               try: gps_socket.close()
+               except: pass
+           self.stop_event.wait(delay)
+           delay = min(delay * 2, GPS_RECONNECT_MAX_DELAY)
+
+
+   def handle_line(self, line):
        try:
-           ser.close()
-       except:
-           pass
-   return None
+           msg = json.loads(line)
+       except ValueError:
+           return
+       if not isinstance(msg, dict) or msg.get('class') != 'TPV':
+           return
+       lat = msg.get('lat'); lon = msg.get('lon')
+       if lat is None or lon is None:
+           return
+       epx = msg.get('epx'); epy = msg.get('epy')
+       accuracy = max(float(epx), float(epy)) if epx is not None and epy is not None else None
+       self.on_fix(float(lat), float(lon), accuracy, 'gpsd')
 
 
-def get_precise_gps():
-   try:
-       g = read_gpsd_once(timeout=0.8)
-       if g:
-           lat, lon, acc = g
-           return lat, lon, acc, 'gpsd'
-   except Exception:
-       pass
-   try:
-       s = read_serial_gps_once(timeout=0.8)
-       if s:
-           lat, lon, acc = s
-           return lat, lon, acc, 'serial'
-   except Exception:
-       pass
-   return None
+class SerialNmeaReader(threading.Thread):
+   """Keeps the serial GPS port open and reports every valid GGA/RMC fix to on_fix."""
+   def __init__(self, on_fix, stop_event, devpath=GPS_SERIAL_DEVICE, baud=GPS_BAUDRATE):
+       super().__init__(daemon=True)
+       self.on_fix = on_fix; self.stop_event = stop_event
+       self.devpath = devpath; self.baud = baud
+
+
+   def run(self):
+       delay = 1.0
+       while not self.stop_event.is_set():
+           try:
+               ser = serial.Serial(self.devpath, baudrate=self.baud, timeout=1.0)
+           except Exception:
+               self.stop_event.wait(delay)
+               delay = min(delay * 2, GPS_RECONNECT_MAX_DELAY)
+               continue
+           print("[GPS serial] reading", self.devpath)
+           delay = 1.0
+           try:
+               while not self.stop_event.is_set():
+                   line = ser.readline().decode(errors='ignore').strip()
+                   if not line:
+                       continue
+                   fix = parse_nmea_fix(line)
+                   if fix:
+                       lat, lon, acc = fix
+                       self.on_fix(lat, lon, acc, 'serial')
+           except Exception as e:
+               print("[GPS serial] read error:", e)
+           finally:
+               try: ser.close()
+               except: pass
+
+
+class LocationService(threading.Thread):
+   """
+   Keeps latest_location fresh from the long-lived gpsd / serial readers, falls back to IP
+   geolocation when neither has a recent fix, and forwards updates to the app clients.
+   Runs entirely off the vision loop.
+   """
+   SOURCE_PRIORITY = ('gpsd', 'serial')
+
+
+   def __init__(self, gateway=None, stop_event=None):
+       super().__init__(daemon=True)
+       self.gateway = gateway
+       self.stop_event = stop_event or threading.Event()
+       self.fix_lock = threading.Lock()
+       self.fixes = {}
+       self.last_ip_lookup = 0.0
+
+
+   def on_fix(self, lat, lon, acc, src):
+       with self.fix_lock:
+           self.fixes[src] = (lat, lon, acc, time.time())
+
+
+   def best_fix(self):
+       now = time.time()
+       with self.fix_lock:
+           for src in self.SOURCE_PRIORITY:
+               fix = self.fixes.get(src)
+               if fix and now - fix[3] <= GPS_FIX_MAX_AGE:
+                   lat, lon, acc, ts = fix
+                   return lat, lon, acc, src, ts
+       return None
+
+
+   def run(self):
+       if GPSD_AVAILABLE:
+           GpsdReader(self.on_fix, self.stop_event).start()
+       if PYNMEA_AVAILABLE:
+           SerialNmeaReader(self.on_fix, self.stop_event).start()
+       last_src = None
+       while not self.stop_event.is_set():
+           try:
+               fix = self.best_fix()
+               if fix:
+                   lat, lon, acc, src, ts = fix
+                   with frame_lock:
+                       latest_location['lat'] = lat
+                       latest_location['lon'] = lon
+                       latest_location['timestamp'] = ts
+                       latest_location['gps_source'] = src
+                       latest_location['accuracy'] = acc
+                   if src != last_src:
+                       print(f"[GPS] precise coords from {src}: {lat},{lon} (acc={acc})")
+                   last_src = src
+               elif time.time() - self.last_ip_lookup >= IP_LOCATION_INTERVAL:
+                   self.last_ip_lookup = time.time()
+                   loc = get_location()
+                   with frame_lock:
+                       latest_location['lat'] = loc.get('lat')
+                       latest_location['lon'] = loc.get('lon')
+                       latest_location['host_ip'] = loc.get('host_ip')
+                       latest_location['timestamp'] = loc.get('timestamp')
+                       latest_location['gps_source'] = 'ip'
+                       latest_location['accuracy'] = None
+                   print("[GPS] precise not found, used IP fallback:", loc.get('host_ip'))
+                   last_src = 'ip'
+               if self.gateway:
+                   with frame_lock:
+                       loc = latest_location.copy()
+                   self.gateway.send_location(loc)
+           except Exception as e:
+               print("[GPS] location service error:", e)
+           self.stop_event.wait(GPS_POLL_INTERVAL)
 
 
 # -----------------------
-# ONNX helpers (unchanged)
+# ONNX helpers
 # -----------------------
-def choose_session(model_path: str):
+GRAPH_OPT_LEVELS = {
+   "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+   "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+   "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+   "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+
+def optimized_model_cache_path(model_path, profile_name, cache_dir, providers):
+   """Cache file keyed on model file, profile, providers and ORT version, so stale caches are never loaded."""
+   st = os.stat(model_path)
+   base = os.path.splitext(os.path.basename(model_path))[0]
+   key = f"{st.st_size}-{int(st.st_mtime)}-{profile_name}-{'+'.join(providers)}-{ort.__version__}"
+   digest = format(zlib.crc32(key.encode('utf-8')), '08x')
+   return os.path.join(cache_dir, f"{base}.{profile_name}.{digest}.ort.onnx")
+
+
+def build_session_options(profile):
+   """Returns (SessionOptions, applied) where applied lists what the profile actually set."""
+   so = ort.SessionOptions()
+   applied = {}
+   if 'intra_op_threads' in profile:
+       n = int(profile['intra_op_threads']) or (os.cpu_count() or 1)
+       so.intra_op_num_threads = n
+       applied['intra_op_threads'] = n
+   if 'inter_op_threads' in profile:
+       so.inter_op_num_threads = int(profile['inter_op_threads'])
+       applied['inter_op_threads'] = int(profile['inter_op_threads'])
+   if 'execution_mode' in profile:
+       parallel = profile['execution_mode'] == 'parallel'
+       so.execution_mode = ort.ExecutionMode.ORT_PARALLEL if parallel else ort.ExecutionMode.ORT_SEQUENTIAL
+       applied['execution_mode'] = 'parallel' if parallel else 'sequential'
+   if 'graph_optimization' in profile:
+       so.graph_optimization_level = GRAPH_OPT_LEVELS[profile['graph_optimization']]
+       applied['graph_optimization'] = profile['graph_optimization']
+   if 'cpu_mem_arena' in profile:
+       so.enable_cpu_mem_arena = bool(profile['cpu_mem_arena'])
+       applied['cpu_mem_arena'] = bool(profile['cpu_mem_arena'])
+   if 'mem_pattern' in profile:
+       so.enable_mem_pattern = bool(profile['mem_pattern'])
+       applied['mem_pattern'] = bool(profile['mem_pattern'])
+   if 'allow_spinning' in profile:
+       flag = "1" if profile['allow_spinning'] else "0"
+       so.add_session_config_entry("session.intra_op.allow_spinning", flag)
+       so.add_session_config_entry("session.inter_op.allow_spinning", flag)
+       applied['allow_spinning'] = bool(profile['allow_spinning'])
+   return so, applied
+
+
+def choose_session(model_path: str, profile_name=None):
+   """
+   Builds an InferenceSession from an ORT_PROFILES entry: provider preference (only the
+   ones this onnxruntime build has), thread counts, graph optimization level, memory arena
+   settings and an on-disk cache of the optimized graph for faster startup. What was
+   actually applied is printed and kept in session_info (exposed on /status).
+
+   ORT refuses to serialize a graph containing nodes compiled by an execution provider
+   (OpenVINO, XNNPACK), and session creation fails if asked to, so the optimized-graph cache is
+   only used when every chosen provider is the CPU one. OpenVINO caches its compiled blobs
+   through its own cache_dir option instead.
+   """
+   profile_name = profile_name or ORT_PROFILE
+   if profile_name not in ORT_PROFILES:
+       print(f"Unknown ORT profile {profile_name!r}, using 'default'")
+       profile_name = "default"
+   profile = ORT_PROFILES[profile_name]
+   t0 = time.time()
+
+
    available = ort.get_available_providers()
-   apple_order = ['MPSExecutionProvider', 'CoreMLExecutionProvider', 'MetalExecutionProvider']
-   chosen = []
-   for p in apple_order:
-       if p in available:
-           chosen.append(p)
-   if 'CPUExecutionProvider' in available:
-       chosen.append('CPUExecutionProvider')
+   chosen = [p for p in profile.get('providers', []) if p in available]
+   provider_options = profile.get('provider_options', {})
+   print("Available ONNX providers:", available)
+   so, applied = build_session_options(profile)
+
+
+   load_path = model_path
+   cache = None
+   cache_dir = profile.get('optimized_model_cache')
+   cpu_only = all(p == 'CPUExecutionProvider' for p in (chosen or available))
+   if cache_dir and 'OpenVINOExecutionProvider' in chosen:
+       ov_options = dict(provider_options.get('OpenVINOExecutionProvider', {}))
+       ov_options.setdefault('cache_dir', os.path.join(cache_dir, 'openvino'))
+       os.makedirs(ov_options['cache_dir'], exist_ok=True)
+       provider_options = dict(provider_options, OpenVINOExecutionProvider=ov_options)
+       applied['openvino_cache_dir'] = ov_options['cache_dir']
+   if cache_dir and cpu_only and os.path.exists(model_path):
+       cache_path = optimized_model_cache_path(model_path, profile_name, cache_dir, chosen)
+       if os.path.exists(cache_path):
+           # graph was optimized when the cache was written; skip doing it again
+           load_path = cache_path
+           so.graph_optimization_level = GRAPH_OPT_LEVELS['disable']
+           cache = 'hit'
+       else:
+           os.makedirs(cache_dir, exist_ok=True)
+           so.optimized_model_filepath = cache_path
+           cache = 'written'
+       applied['optimized_model_cache'] = cache_path
+
+
    if not chosen:
        print("No known providers found. Using default provider order.")
-       sess = ort.InferenceSession(model_path)
+       sess = ort.InferenceSession(load_path, sess_options=so)
    else:
-       providers_to_use = [p for p in chosen if p in available]
-       print("Available ONNX providers:", available)
-       print("Using provider order:", providers_to_use)
-       sess = ort.InferenceSession(model_path, providers=providers_to_use)
+       print("Using provider order:", chosen)
+       opts = [provider_options.get(p, {}) for p in chosen]
+       sess = ort.InferenceSession(load_path, sess_options=so, providers=chosen, provider_options=opts)
+
+
+   session_info.clear()
+   session_info.update({
+       'profile': profile_name,
+       'model': model_path,
+       'providers': sess.get_providers(),
+       'options': applied,
+       'cache': cache,
+       'load_ms': round((time.time() - t0) * 1000.0, 1),
+   })
+   print("ONNX session:", session_info)
    return sess
 
 
+def drift_report_path(model_path):
+   return model_path + ".drift.json"
+
+
+def load_drift_report(model_path):
+   try:
+       with open(drift_report_path(model_path), "r") as f:
+           return json.load(f)
+   except Exception:
+       return None
+
+
+def resolve_model_variant(variant=None):
+   """
+   Returns (variant, model_path, drift_report) for MODEL_VARIANT. Missing files fall back to
+   fp32; "auto" only accepts a quantized variant whose drift report shows the obstacle tuple
+   agreeing with fp32 on at least VARIANT_MIN_PANE_AGREEMENT of the reference frames.
+   """
+   variant = variant or MODEL_VARIANT
+   if variant == "auto":
+       for name in AUTO_VARIANT_ORDER:
+           path = MODEL_VARIANTS.get(name)
+           if not path or not os.path.exists(path):
+               continue
+           if name == "fp32":
+               break
+           report = load_drift_report(path)
+           if report and report.get('pane_agreement', 0.0) >= VARIANT_MIN_PANE_AGREEMENT:
+               return name, path, report
+           print(f"[Model] skipping {name}: no drift report or too much drift vs fp32")
+       return "fp32", MODEL_VARIANTS["fp32"], None
+   path = MODEL_VARIANTS.get(variant)
+   if not path or not os.path.exists(path):
+       print(f"[Model] variant {variant!r} not found ({path}), falling back to fp32")
+       return "fp32", MODEL_VARIANTS["fp32"], None
+   return variant, path, load_drift_report(path) if variant != "fp32" else None
+
+
 def infer_model_input_size(sess):
    try:
        inp = sess.get_inputs()[0]
@@ -284,17 +625,126 @@ def infer_model_input_size(sess):
    return 256
 
 
-def preprocess(frame_bgr, target_size):
-   img = cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
-   img_resized = cv2.resize(img, (target_size, target_size), interpolation=cv2.INTER_AREA)
-   img_resized = (img_resized - MEAN) / STD
-   img_chw = np.transpose(img_resized, (2, 0, 1)).astype(np.float32)
-   return np.expand_dims(img_chw, 0)
+def model_has_dynamic_hw(sess):
+   """True when the model's input height/width are symbolic, i.e. any size can be fed."""
+   try:
+       shape = sess.get_inputs()[0].shape
+       return len(shape) >= 2 and not all(isinstance(d, int) for d in shape[-2:])
+   except Exception:
+       return False
 
 
-def postprocess_depth(pred, out_w, out_h, invert=False):
-   if pred is None:
-       return np.zeros((out_h, out_w), dtype=np.float32)
+def model_has_dynamic_batch(sess):
+   try:
+       return not isinstance(sess.get_inputs()[0].shape[0], int)
+   except Exception:
+       return False
+
+
+class AdaptiveResolution:
+   """
+   Picks the model input size for the next frame from ADAPTIVE_SIZES. Steps down when the
+   smoothed inference time is over budget, steps up when the next size's predicted time
+   (scaled by pixel count) is comfortably under it, and uses a smaller budget while the scene
+   is clear. Sizes hold for at least hold_frames frames so it does not oscillate.
+   """
+   def __init__(self, sizes=ADAPTIVE_SIZES, budget_ms=ADAPTIVE_BUDGET_MS, start=None,
+                hold_frames=ADAPTIVE_HOLD_FRAMES, hysteresis=ADAPTIVE_HYSTERESIS, alpha=0.2):
+       self.sizes = sorted(int(x) for x in sizes)
+       self.idx = self.sizes.index(start) if start in self.sizes else len(self.sizes) // 2
+       self.budget_ms = budget_ms; self.hold_frames = hold_frames
+       self.hysteresis = hysteresis; self.alpha = alpha
+       self.ema_ms = None; self.since_change = 0
+
+
+   @property
+   def size(self):
+       return self.sizes[self.idx]
+
+
+   def update(self, infer_ms, obstacle_near):
+       """Feed the last frame's inference time; returns the size to use for the next frame."""
+       if self.ema_ms is None:
+           self.ema_ms = infer_ms
+       else:
+           self.ema_ms += self.alpha * (infer_ms - self.ema_ms)
+       self.since_change += 1
+       if self.since_change < self.hold_frames:
+           return self.size
+       budget = self.budget_ms if obstacle_near else self.budget_ms * ADAPTIVE_CLEAR_BUDGET_SCALE
+       new_idx = self.idx
+       if self.ema_ms > budget and self.idx > 0:
+           new_idx = self.idx - 1
+       elif self.idx < len(self.sizes) - 1:
+           predicted = self.ema_ms * (self.sizes[self.idx + 1] / float(self.size)) ** 2
+           if predicted < budget * (1.0 - self.hysteresis):
+               new_idx = self.idx + 1
+       if new_idx != self.idx:
+           # rescale the estimate so the next decision does not act on the old size's timing
+           self.ema_ms *= (self.sizes[new_idx] / float(self.size)) ** 2
+           self.idx = new_idx
+           self.since_change = 0
+       return self.size
+
+
+class MotionGate:
+   """
+   Decides whether a frame needs fresh inference. The score is the mean absolute difference
+   between small grayscale thumbnails of this frame and the last frame that was inferred, so
+   slow drift still adds up; refresh_frames forces inference when the scene stays static.
+   """
+   def __init__(self, threshold=MOTION_THRESHOLD, refresh_frames=MOTION_REFRESH_FRAMES, thumb=MOTION_THUMB_SIZE):
+       self.threshold = threshold; self.refresh_frames = refresh_frames; self.thumb = thumb
+       self.small = np.empty((thumb, thumb, 3), dtype=np.uint8)
+       self.cur = np.empty((thumb, thumb), dtype=np.uint8)
+       self.ref = None
+       self.since_refresh = 0
+
+
+   def should_infer(self, frame_bgr):
+       """Returns (infer, score)."""
+       cv2.resize(frame_bgr, (self.thumb, self.thumb), dst=self.small, interpolation=cv2.INTER_AREA)
+       cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.cur)
+       if self.ref is None:
+           self.ref = np.empty_like(self.cur)
+           np.copyto(self.ref, self.cur)
+           self.since_refresh = 0
+           return True, 0.0
+       score = cv2.norm(self.cur, self.ref, cv2.NORM_L1) / self.cur.size
+       if score >= self.threshold or self.since_refresh + 1 >= self.refresh_frames:
+           self.ref, self.cur = self.cur, self.ref
+           self.since_refresh = 0
+           return True, score
+       self.since_refresh += 1
+       return False, score
+
+
+class DepthPreprocessor:
+   """
+   MiDaS input path without per-frame allocations: the BGR frame is resized while still
+   uint8, then a per-channel lookup table does BGR->RGB, /255, mean/std normalization and
+   the HWC->NCHW layout change in a single pass into a reused input tensor.
+   """
+   def __init__(self, target_size):
+       self.target_size = int(target_size)
+       self.small = np.empty((self.target_size, self.target_size, 3), dtype=np.uint8)
+       self.tensor = np.empty((1, 3, self.target_size, self.target_size), dtype=np.float32)
+       levels = np.arange(256, dtype=np.float32) / 255.0
+       self.luts = [(levels - MEAN[c]) / STD[c] for c in range(3)]
+
+
+   def __call__(self, frame_bgr, out=None):
+       """Fills out (a (3,H,W) view, e.g. one item of a batch) or the own (1,3,H,W) tensor."""
+       ts = self.target_size
+       cv2.resize(frame_bgr, (ts, ts), dst=self.small, interpolation=cv2.INTER_AREA)
+       dst = self.tensor[0] if out is None else out
+       for c in range(3):
+           # tensor channels are RGB, the frame is BGR
+           np.take(self.luts[c], self.small[:, :, 2 - c], out=dst[c], mode='clip')
+       return self.tensor if out is None else out
+
+
+def squeeze_depth(pred):
    arr = pred
    if arr.ndim == 4:
        arr = arr[0, 0]
@@ -302,59 +752,194 @@ def postprocess_depth(pred, out_w, out_h, invert=False):
        arr = arr[0]
    elif arr.ndim == 3 and arr.shape[2] == 1:
        arr = arr[:, :, 0]
-   interp = cv2.INTER_CUBIC if USE_CUBIC_RESIZE else cv2.INTER_LINEAR
-   arr_resized = cv2.resize(arr, (out_w, out_h), interpolation=interp)
-   if invert:
-       arr_resized = 1.0 / (arr_resized + 1e-6)
-   dmin, dmax = float(arr_resized.min()), float(arr_resized.max())
-   if dmax - dmin > 1e-6:
-       norm = (arr_resized - dmin) / (dmax - dmin)
-   else:
-       norm = np.zeros_like(arr_resized)
-   return norm
+   return np.asarray(arr, dtype=np.float32)
 
 
-def colorize_depth(dmap_01):
-   disp = (dmap_01 * 255.0).astype(np.uint8)
-   color = cv2.applyColorMap(disp, cv2.COLORMAP_INFERNO)
-   return color
+def robust_range(arr, percentiles=DEPTH_NORM_PERCENTILES, stride=DEPTH_SAMPLE_STRIDE):
+   """
+   Low/high percentiles of a 2-D map estimated on a strided subsample with a partial sort,
+   a fraction of the cost of np.percentile over the whole map and unaffected by a few
+   outlier pixels the way min/max is.
+   """
+   # flatten() always copies: with stride 1 ravel() would be a view and partition() would
+   # reorder the caller's map in place
+   sample = arr[::stride, ::stride].flatten()
+   if sample.size == 0:
+       return 0.0, 0.0
+   k_lo = int(round(percentiles[0] / 100.0 * (sample.size - 1)))
+   k_hi = int(round(percentiles[1] / 100.0 * (sample.size - 1)))
+   sample.partition((k_lo, k_hi))
+   return float(sample[k_lo]), float(sample[k_hi])
+
+
+def normalize_range(arr, lo, hi):
+   """Maps [lo, hi] to [0, 1] in place: scale and shift run as a single cv2 pass, then clip."""
+   if hi - lo <= 1e-6:
+       arr.fill(0.0)
+       return arr
+   scale = 1.0 / (hi - lo)
+   cv2.addWeighted(arr, scale, arr, 0.0, -lo * scale, dst=arr)
+   np.clip(arr, 0.0, 1.0, out=arr)
+   return arr
+
+
+class DepthStabilizer:
+   """
+   Normalizes depth against EMA-smoothed low/high percentiles and keeps a temporally filtered
+   map, all updated in place. When the input size changes (adaptive resolution) the filtered
+   map is resized rather than reset so the output stays continuous.
+   """
+   def __init__(self, percentiles=DEPTH_NORM_PERCENTILES, scale_alpha=DEPTH_SCALE_ALPHA, temporal_alpha=DEPTH_TEMPORAL_ALPHA):
+       self.percentiles = percentiles
+       self.scale_alpha = scale_alpha; self.temporal_alpha = temporal_alpha
+       self.lo = None; self.hi = None
+       self.filtered = None
 
 
-def detect_close_panes(dmap, threshold=CLOSE_THRESH, min_area=MIN_BLOB_AREA):
+   def update_scale(self, arr):
+       lo_t, hi_t = robust_range(arr, self.percentiles, stride=DEPTH_SAMPLE_STRIDE)
+       if self.lo is None:
+           self.lo, self.hi = lo_t, hi_t
+       else:
+           self.lo += self.scale_alpha * (lo_t - self.lo)
+           self.hi += self.scale_alpha * (hi_t - self.hi)
+
+
+   def __call__(self, arr):
+       """Stabilizes arr (float32, raw depth) in place and returns it, normalized to [0, 1]."""
+       self.update_scale(arr)
+       if self.hi - self.lo <= 1e-6:
+           arr.fill(0.0)
+           return arr
+       normalize_range(arr, self.lo, self.hi)
+       if self.filtered is None:
+           self.filtered = arr.copy()
+       else:
+           if self.filtered.shape != arr.shape:
+               self.filtered = cv2.resize(self.filtered, (arr.shape[1], arr.shape[0]), interpolation=cv2.INTER_LINEAR)
+           cv2.accumulateWeighted(arr, self.filtered, self.temporal_alpha)
+           np.copyto(arr, self.filtered)
+       return arr
+
+
+class DepthPostprocessor:
+   """
+   Normalizes model output at its native resolution, in place, either per frame (robust
+   percentiles) or through a DepthStabilizer. Upsampling to the camera frame is left to the
+   overlay renderer since only the visualization needs it.
+   """
+   def __init__(self, stabilizer=None):
+       self.stabilizer = stabilizer
+
+
+   def __call__(self, pred, invert=False, out=None):
+       """
+       out (float32, shape of the squeezed prediction) is the buffer to normalize into; the
+       inference thread passes the frame's FrameRing slot. Without it a new map is allocated,
+       which is what offline callers such as quantize_midas.py want.
+       """
+       arr = squeeze_depth(pred)
+       if out is None:
+           out = np.empty(arr.shape, dtype=np.float32)
+       if invert:
+           np.add(arr, 1e-6, out=out)
+           np.reciprocal(out, out=out)
+       else:
+           np.copyto(out, arr)
+       if self.stabilizer is not None:
+           return self.stabilizer(out)
+       lo, hi = robust_range(out, DEPTH_NORM_PERCENTILES, stride=DEPTH_SAMPLE_STRIDE)
+       return normalize_range(out, lo, hi)
+
+
+def colorize_depth(dmap_01, out_u8=None, out=None):
+   """Pass out_u8 / out (matching uint8 buffers) to colorize without allocating."""
+   if out_u8 is None:
+       out_u8 = np.empty(dmap_01.shape, dtype=np.uint8)
+   np.multiply(dmap_01, 255.0, out=out_u8, casting='unsafe')
+   if out is None:
+       return cv2.applyColorMap(out_u8, cv2.COLORMAP_INFERNO)
+   cv2.applyColorMap(out_u8, cv2.COLORMAP_INFERNO, dst=out)
+   return out
+
+
+def detect_close_panes(dmap, threshold=CLOSE_THRESH, min_area=MIN_BLOB_AREA, out_size=None, panes=None):
+   """
+   Finds close blobs on the depth map at whatever resolution it comes in (normally the model's
+   native output), so the cost does not depend on the camera resolution. out_size is the
+   (w, h) frame the results are reported in: min_area is in those pixels and bbox / cx are
+   scaled up to it for drawing. Per-blob mean depth comes from a single connected-component
+   labeling pass plus a weighted bincount.
+   """
+   panes = panes or PANE_COUNT
+   empty = (0,) * panes
    h, w = dmap.shape
-   mask = (dmap >= threshold).astype(np.uint8) * 255
+   out_w, out_h = out_size or (w, h)
+   sx = out_w / float(w); sy = out_h / float(h)
+   mask = (dmap >= threshold).astype(np.uint8)
    kernel = np.ones((3,3), np.uint8)
    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
-   contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+   n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+   if n <= 1:
+       return empty, []
+   areas = stats[:, cv2.CC_STAT_AREA]
+   sums = np.bincount(labels.ravel(), weights=dmap.ravel(), minlength=n)
+   means = sums / np.maximum(areas, 1)
    blobs = []
-   for cnt in contours:
-       area = cv2.contourArea(cnt)
+   for i in range(1, n):
+       area = float(areas[i]) * sx * sy
        if area < min_area:
            continue
-       x,y,ww,hh = cv2.boundingRect(cnt)
-       submask = np.zeros_like(mask)
-       cv2.drawContours(submask, [cnt], -1, 255, -1)
-       mean_depth = cv2.mean(dmap, mask=submask)[0] if dmap.ndim==2 else np.mean(dmap[submask>0])
-       M = cv2.moments(cnt)
-       if M['m00'] != 0:
-           cx = int(M['m10']/M['m00'])
-       else:
-           cx = x + ww//2
-       blobs.append({'area':area, 'mean_depth':mean_depth, 'cx':cx, 'bbox':(x,y,ww,hh)})
+       x, y, ww, hh = stats[i, :4]
+       bbox = (int(x * sx), int(y * sy), int(np.ceil(ww * sx)), int(np.ceil(hh * sy)))
+       blobs.append({'area':area, 'mean_depth':float(means[i]), 'cx':int(centroids[i][0] * sx), 'bbox':bbox})
    if not blobs:
-       return (0,0,0), []
+       return empty, []
    blobs = sorted(blobs, key=lambda b: b['mean_depth'], reverse=True)
-   out = [0,0,0]
-   pane_width = w / 3.0
+   out = [0] * panes
+   pane_width = out_w / float(panes)
    picks = []
-   for b in blobs[:3]:
+   for b in blobs[:panes]:
        pane_idx = int(b['cx'] // pane_width)
-       pane_idx = min(max(pane_idx, 0), 2)
+       pane_idx = min(max(pane_idx, 0), panes - 1)
        out[pane_idx] = 1
        picks.append((pane_idx, b))
    return tuple(out), picks
 
 
+def pane_summary(dmap, panes=None, threshold=CLOSE_THRESH, percentile=PANE_NEAR_PERCENTILE, stride=DEPTH_SAMPLE_STRIDE):
+   """
+   Graded per-pane obstacle summary, from column reductions over every stride-th row of the
+   native depth map. 'near' is the max over the pane's columns of each column's percentile
+   (a thin pole still counts, a few noisy pixels do not); 'occupied' is the fraction of the
+   pane at or above threshold. Lists run left to right.
+   """
+   panes = panes or PANE_COUNT
+   sample = dmap[::stride]
+   h, w = sample.shape
+   k = min(h - 1, int(round((h - 1) * percentile / 100.0)))
+   col_near = np.partition(sample, k, axis=0)[k]
+   col_occ = np.count_nonzero(sample >= threshold, axis=0)
+   edges = np.linspace(0, w, panes + 1).astype(np.intp)
+   near = np.maximum.reduceat(col_near, edges[:-1])
+   occupied = np.add.reduceat(col_occ, edges[:-1]) / (h * np.diff(edges)).astype(np.float32)
+   return {'near': np.round(near, 3).tolist(), 'occupied': np.round(occupied, 3).tolist()}
+
+
+def merge_pane_summaries(summaries):
+   """Per-pane max over cameras, in the spirit of merge_tuples."""
+   summaries = [s for s in summaries if s]
+   if not summaries:
+       return {}
+   return {key: [max(v) for v in zip(*(s[key] for s in summaries))] for key in summaries[0]}
+
+
+def pane_intensities(near, floor=PANE_INTENSITY_FLOOR):
+   """ESP vibration intensity per pane from pane_summary 'near': 0 up to floor, then 1..255."""
+   scale = 255.0 / max(1e-6, 1.0 - floor)
+   return [0 if v <= floor else min(255, max(1, int(round((v - floor) * scale)))) for v in near]
+
+
 def get_location():
    loc = {'timestamp': time.time(), 'lat': None, 'lon': None, 'host_ip': None}
    try:
@@ -379,138 +964,784 @@ def get_location():
 
 
 # -----------------------
-# TCP servers
+# Device gateway (ESP units + app clients)
 # -----------------------
-class ESPServer(threading.Thread):
-   def __init__(self, host, port):
+ESP_FRAME_MAGIC = 0xA5
+ESP_FLAG_INTENSITY = 0x01
+ESP_FLAG_HEARTBEAT = 0x02
+# magic, version, flags, pane count, seq, timestamp (ms, wraps), pane bitmask (bit i = pane i)
+ESP_FRAME_HEADER = struct.Struct("<BBBBHIB")
+
+
+def encode_esp_frame(seq, tpl, intensities=None, ts=None, heartbeat=False):
+   """
+   Binary obstacle frame: ESP_FRAME_HEADER, then one intensity byte per pane when
+   ESP_FLAG_INTENSITY is set, then an XOR checksum of all preceding bytes.
+   """
+   flags = (ESP_FLAG_INTENSITY if intensities is not None else 0) | (ESP_FLAG_HEARTBEAT if heartbeat else 0)
+   mask = 0
+   for i, v in enumerate(tpl):
+       if v:
+           mask |= 1 << i
+   ts_ms = int((time.time() if ts is None else ts) * 1000.0) & 0xFFFFFFFF
+   frame = bytearray(ESP_FRAME_HEADER.pack(ESP_FRAME_MAGIC, ESP_PROTOCOL_VERSION, flags, len(tpl), seq & 0xFFFF, ts_ms, mask))
+   if intensities is not None:
+       frame += bytes(intensities)
+   frame.append(functools.reduce(lambda a, b: a ^ b, frame, 0))
+   return bytes(frame)
+
+
+def quantize_intensities(intensities, levels=ESP_INTENSITY_LEVELS):
+   if intensities is None:
+       return None
+   step = 255.0 / (levels - 1)
+   # a non-zero intensity stays non-zero, so a faint obstacle is never quantized away
+   return tuple(0 if v <= 0 else max(1, int(round(round(v / step) * step))) for v in intensities)
+
+
+class GatewayClient:
+   """
+   One connected ESP or app socket, written by its own sender task. Outbound messages wait in
+   two places: `latest`, a depth-1 slot where a newer frame/tuple replaces an unsent one, and
+   `reliable`, an ordered queue (LOC messages) that is sent first and never dropped from.
+   """
+   def __init__(self, kind, writer, reliable_max=GATEWAY_RELIABLE_QUEUE):
+       self.kind = kind; self.writer = writer
+       self.peer = writer.get_extra_info('peername')
+       self.latest = None
+       self.reliable = collections.deque()
+       self.reliable_max = reliable_max
+       self.wake = asyncio.Event()
+       self.dropped = 0
+       self.closing = False
+       self.protocol = ESP_PROTOCOL
+
+
+   def on_data(self, data):
+       """ESP units may choose their obstacle protocol with a "BIN1" / "TXT" line."""
+       if self.kind != 'esp':
+           return
+       line = data.strip().upper()
+       if line.startswith(b'BIN'):
+           self.protocol = 'binary'
+       elif line.startswith(b'TXT'):
+           self.protocol = 'text'
+
+
+   def offer(self, payload, latest=False):
+       """Queue payload (event loop thread only)."""
+       if self.closing:
+           return
+       if isinstance(payload, dict):
+           # per-protocol variants of one message; nothing due for this client's protocol
+           payload = payload.get(self.protocol)
+           if payload is None:
+               return
+       if latest:
+           if self.latest is not None:
+               self.dropped += 1
+           self.latest = payload
+       elif len(self.reliable) >= self.reliable_max:
+           print(f"[Gateway] {self.kind} {self.peer} not reading, disconnecting")
+           self.abort()
+           return
+       else:
+           self.reliable.append(payload)
+       self.wake.set()
+
+
+   async def sender(self):
+       try:
+           while True:
+               await self.wake.wait()
+               self.wake.clear()
+               while self.reliable or self.latest is not None:
+                   if self.reliable:
+                       payload = self.reliable.popleft()
+                   else:
+                       payload, self.latest = self.latest, None
+                   self.writer.write(payload)
+                   # while this waits on a slow client, newer frames just replace self.latest
+                   await self.writer.drain()
+       except (ConnectionError, OSError) as e:
+           print(f"[Gateway] {self.kind} {self.peer} send error:", e)
+           self.abort()
+
+
+   def abort(self):
+       """
+       Drop the connection now. writer.close() would wait for the send buffer to drain, which
+       never happens for a peer that stopped reading; abort() discards it, which ends the
+       pending read in DeviceGateway.handle and with it the client.
+       """
+       self.closing = True
+       self.writer.transport.abort()
+
+
+class DeviceGateway(threading.Thread):
+   """
+   One asyncio event loop serving any number of ESP units (ESP_PORT) and app clients
+   (APP_PORT), replacing the old one-client-per-thread ESPServer / AppServer. Disconnects
+   show up as EOF on each client's read; each client has its own send queues (see
+   GatewayClient), so a slow Wi-Fi client skips frames instead of holding anyone up.
+   send_tuple / send_frame / send_location keep the old wire formats and are safe to call
+   from any thread: they encode once and hand the bytes to the loop, never waiting on the network.
+   """
+   def __init__(self, esp_addr=None, app_addr=None):
        super().__init__(daemon=True)
-       self.host = host; self.port = port
-       self.client = None; self.sock = None; self.lock = threading.Lock(); self.last_sent = 0.0
+       self.addrs = {'esp': esp_addr or (ESP_HOST, ESP_PORT), 'app': app_addr or (APP_HOST, APP_PORT)}
+       self.clients = {'esp': set(), 'app': set()}
+       self.loop = None
+       self.last_text = 0.0
+       self.last_binary = 0.0
+       self.last_state = None
+       self.esp_seq = 0
 
 
    def run(self):
-       self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+       self.loop = asyncio.new_event_loop()
+       asyncio.set_event_loop(self.loop)
        try:
-           self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-           self.sock.bind((self.host, self.port))
-           self.sock.listen(1)
-           print(f"[ESPServer] listening on {self.host}:{self.port}")
+           self.loop.run_until_complete(self.serve())
        except Exception as e:
-           print("[ESPServer] bind/listen error:", e)
-           return
-       while True:
+           print("[Gateway] Exception:", e)
+
+
+   async def serve(self):
+       servers = []
+       for kind, (host, port) in self.addrs.items():
            try:
-               conn, addr = self.sock.accept()
-               print("[ESPServer] ESP connected from", addr)
-               # set keepalive so dead connections are detected later at TCP level
-               try:
-                   conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-               except Exception:
-                   pass
-               with self.lock:
-                   if self.client:
-                       try:
-                           self.client.close()
-                       except:
-                           pass
-                   self.client = conn
-               # do not try to recv() here — keep the socket open and let send_tuple handle errors
-               # block here until the socket is closed by other side or send fails
-               while True:
-                   time.sleep(1.0)
-                   with self.lock:
-                       if self.client is not conn:
-                           break
-                       # optionally check socket health by a non-blocking recv peek
-                       # but keep it simple for MicroPython clients
-               print("[ESPServer] ESP disconnected (handler loop exit)")
-               with self.lock:
-                   if self.client:
-                       try:
-                           self.client.close()
-                       except:
-                           pass
-                       self.client = None
-           except Exception as e:
-               print("[ESPServer] Exception:", e)
-               time.sleep(1)
+               srv = await asyncio.start_server(functools.partial(self.handle, kind), host or None, port, reuse_address=True)
+           except OSError as e:
+               print(f"[Gateway] {kind} bind/listen error:", e)
+               continue
+           print(f"[Gateway] {kind} clients on {host}:{port}")
+           servers.append(srv)
+       await asyncio.gather(*(srv.serve_forever() for srv in servers))
 
 
-   def send_tuple(self, tpl):
-       now = time.time()
-       if now - self.last_sent < ESP_SEND_INTERVAL:
-           return
-       with self.lock:
-           if not self.client: return
+   async def handle(self, kind, reader, writer):
+       client = GatewayClient(kind, writer)
+       sock = writer.get_extra_info('socket')
+       if sock is not None:
            try:
-               msg = f"{tuple(int(x) for x in tpl)}\n".encode('ascii')
-               self.client.sendall(msg)
-               self.last_sent = now
-           except Exception as e:
-               print("[ESPServer] send error:", e)
-               try: self.client.close()
-               except: pass
-               self.client = None
+               sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+           except OSError:
+               pass
+       self.clients[kind].add(client)
+       print(f"[Gateway] {kind} connected from", client.peer, f"({len(self.clients[kind])} connected)")
+       sender = asyncio.ensure_future(client.sender())
+       try:
+           # reading is how a disconnect is noticed; the only input is the ESP protocol choice
+           while True:
+               data = await reader.read(256)
+               if not data:
+                   break
+               client.on_data(data)
+       except (ConnectionError, OSError):
+           pass
+       finally:
+           self.clients[kind].discard(client)
+           sender.cancel()
+           await asyncio.gather(sender, return_exceptions=True)
+           writer.close()
+           print(f"[Gateway] {kind} disconnected:", client.peer, f"({client.dropped} messages dropped)")
+
+
+   def publish(self, kind, payload, latest=False):
+       """
+       Queue payload for every client of kind; latest=True for state that a newer message
+       supersedes. Never blocks; a no-op with nobody connected.
+       """
+       loop = self.loop
+       if loop is None or not self.clients[kind] or loop.is_closed():
+           return
+       loop.call_soon_threadsafe(self.offer_all, kind, payload, latest)
+
+
+   def offer_all(self, kind, payload, latest):
+       for client in list(self.clients[kind]):
+           client.offer(payload, latest)
+
+
+   def client_counts(self):
+       return {kind: len(clients) for kind, clients in self.clients.items()}
+
+
+   def has_client(self):
+       """True while at least one app client is connected."""
+       return bool(self.clients['app'])
+
+
+   def send_tuple(self, tpl, intensities=None):
+       """
+       Obstacle state for the ESP units, called once per inference step. Text clients get the
+       tuple every ESP_SEND_INTERVAL; binary clients get a frame when the bitmask or quantized
+       intensities change, and a heartbeat frame when they have not for ESP_HEARTBEAT_INTERVAL.
+       """
+       if not self.clients['esp']:
+           return
+       now = time.time()
+       tpl = tuple(int(x) for x in tpl)
+       state = (tpl, quantize_intensities(intensities))
+       payloads = {}
+       if now - self.last_text >= ESP_SEND_INTERVAL:
+           payloads['text'] = f"{tpl}\n".encode('ascii')
+           self.last_text = now
+       changed = state != self.last_state
+       since = now - self.last_binary
+       if (changed and since >= ESP_MIN_CHANGE_INTERVAL) or since >= ESP_HEARTBEAT_INTERVAL:
+           self.esp_seq = (self.esp_seq + 1) & 0xFFFF
+           payloads['binary'] = encode_esp_frame(self.esp_seq, tpl, state[1], ts=now, heartbeat=not changed)
+           self.last_binary = now
+           self.last_state = state
+       if payloads:
+           self.publish('esp', payloads, latest=True)
+
+
+   def send_frame(self, jpeg_bytes):
+       self.publish('app', b'FRAM' + struct.pack(">I", len(jpeg_bytes)) + jpeg_bytes, latest=True)
+
+
+   def send_location(self, loc_dict):
+       payload = json.dumps(loc_dict).encode('utf-8')
+       self.publish('app', b'LOC ' + struct.pack(">I", len(payload)) + payload)
+
+
+# -----------------------
+# Pipeline stages
+# -----------------------
+class LatestSlot:
+   """
+   Bounded latest-value slot between pipeline stages.
+   put() overwrites whatever is pending, so a slow consumer only ever sees the newest item.
+   Slots built with the same cond can be waited on together with wait_any().
+   """
+   def __init__(self, cond=None):
+       self.cond = cond or threading.Condition()
+       self.item = None
+       self.seq = 0
+       self.closed = False
+
+
+   def put(self, item):
+       with self.cond:
+           self.item = item
+           self.seq += 1
+           self.cond.notify_all()
+           return self.seq
+
+
+   def get(self, last_seq=0, timeout=None):
+       """
+       Wait for an item newer than last_seq. Returns (seq, item), or (last_seq, None)
+       on timeout or once the slot is closed.
+       """
+       with self.cond:
+           self.cond.wait_for(lambda: self.seq > last_seq or self.closed, timeout)
+           if self.seq <= last_seq:
+               return last_seq, None
+           return self.seq, self.item
+
 
+   def close(self):
+       with self.cond:
+           self.closed = True
+           self.cond.notify_all()
 
-class AppServer(threading.Thread):
-   def __init__(self, host, port):
+
+def wait_any(slots, last_seqs, timeout=None):
+   """
+   Wait until any of slots (sharing one condition) has an item newer than its entry in
+   last_seqs. Returns [(seq, item)] per slot, item None where nothing is new.
+   """
+   cond = slots[0].cond
+   with cond:
+       cond.wait_for(lambda: any(s.seq > l or s.closed for s, l in zip(slots, last_seqs)), timeout)
+       return [(s.seq, s.item) if s.seq > l else (l, None) for s, l in zip(slots, last_seqs)]
+
+
+def orient_frame(frame, out=None, tmp=None):
+   """
+   Mirror and rotate a raw camera frame into the orientation the model and panes expect.
+   Pass tmp (raw frame shape) and out (rotated shape) to do it without allocating.
+   """
+   frame = cv2.flip(frame, 1, dst=tmp)
+   return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE, dst=out)
+
+
+class FrameSlot:
+   """
+   One preallocated FrameRing entry: the oriented BGR frame, its native-resolution depth map
+   (filled by the inference stage) and the JPEGs encoded from it, keyed by (seq, stream name)
+   so a reader lapped mid-encode can neither store into nor read from the slot's next frame.
+   """
+   __slots__ = ('seq', 't_capture', 'frame', 'depth', 'jpegs')
+
+
+   def __init__(self):
+       self.seq = 0; self.t_capture = 0.0
+       self.frame = None; self.depth = None
+       self.jpegs = {}
+
+
+   def frame_buffer(self, shape):
+       if self.frame is None or self.frame.shape != shape:
+           self.frame = np.empty(shape, dtype=np.uint8)
+       return self.frame
+
+
+   def depth_buffer(self, shape):
+       if self.depth is None or self.depth.shape != shape:
+           self.depth = np.empty(shape, dtype=np.float32)
+       return self.depth
+
+
+   def holds(self, seq):
+       """False once the writer has started reusing this slot for a newer frame."""
+       return self.seq == seq
+
+
+class FrameRing:
+   """
+   Fixed ring of FrameSlots for one camera, so frames are read in place by every stage instead
+   of being copied between them. The capture thread is the only writer: begin_write() hands it
+   the slot under the writer cursor (invalidated while it is filled) and commit() stamps it with
+   the next sequence number. Readers keep their own cursor (the last seq they handled), look
+   slots up with get() and check holds() after using the arrays; a reader lapped by the writer
+   just moves on to a newer frame.
+   """
+   def __init__(self, slots=FRAME_RING_SLOTS):
+       self.slots = [FrameSlot() for _ in range(slots)]
+       self.write_seq = 0
+
+
+   def begin_write(self):
+       slot = self.slots[self.write_seq % len(self.slots)]
+       slot.seq = 0
+       slot.jpegs.clear()
+       return slot
+
+
+   def commit(self, slot, t_capture):
+       self.write_seq += 1
+       slot.t_capture = t_capture
+       slot.seq = self.write_seq
+       return self.write_seq
+
+
+   def get(self, seq):
+       """The slot holding frame seq, or None if it was never written or has been overwritten."""
+       if seq <= 0:
+           return None
+       slot = self.slots[(seq - 1) % len(self.slots)]
+       return slot if slot.seq == seq else None
+
+
+class CaptureThread(threading.Thread):
+   """
+   Reads the camera as fast as it delivers, orients each frame straight into the next
+   FrameRing slot and announces only the newest (t_capture, slot, seq) in out_slot, so frames
+   never queue up in the driver buffer behind a slow inference step. A video file would be
+   read as fast as it decodes, so with pace_fps set it is played back at that rate instead.
+   """
+   def __init__(self, cap, out_slot, stop_event, cam=0, ring=None, pace_fps=None):
        super().__init__(daemon=True)
-       self.host = host; self.port = port; self.client = None; self.sock = None; self.lock = threading.Lock()
+       self.cap = cap; self.out_slot = out_slot; self.stop_event = stop_event
+       self.cam = cam
+       self.ring = ring or FrameRing(FRAME_RING_SLOTS)
+       self.frame_interval = 1.0 / pace_fps if pace_fps else None
+
+
    def run(self):
-       self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+       frames = 0; t_fps = time.time()
+       raw = None; flipped = None
+       t_next = time.time()
        try:
-           self.sock.bind((self.host, self.port))
-           self.sock.listen(1)
-           print(f"[AppServer] listening on {self.host}:{self.port}")
+           while not self.stop_event.is_set():
+               if self.frame_interval:
+                   delay = t_next - time.time()
+                   if delay > 0 and self.stop_event.wait(delay):
+                       break
+                   # after a stall, resume from now rather than racing to catch up
+                   t_next = max(t_next, time.time() - self.frame_interval) + self.frame_interval
+               # read() reuses raw's buffer once the first frame has fixed its size
+               ret, raw = self.cap.read(raw)
+               if not ret:
+                   print(f"[Capture] camera {self.cam}: no frame, stopping")
+                   break
+               t_cap = time.time()
+               if flipped is None or flipped.shape != raw.shape:
+                   flipped = np.empty_like(raw)
+               h, w = raw.shape[:2]
+               slot = self.ring.begin_write()
+               orient_frame(raw, out=slot.frame_buffer((w, h, 3)), tmp=flipped)
+               seq = self.ring.commit(slot, t_cap)
+               self.out_slot.put((t_cap, slot, seq))
+               frames += 1
+               if t_cap - t_fps >= 1.0:
+                   with frame_lock:
+                       pipeline_stats['capture_fps'][self.cam] = frames / (t_cap - t_fps)
+                   frames = 0; t_fps = t_cap
        except Exception as e:
-           print("[AppServer] bind/listen error:", e)
-           return
-       while True:
-           try:
-               conn, addr = self.sock.accept()
-               print("[AppServer] App connected from", addr)
-               with self.lock:
-                   if self.client:
-                       try: self.client.close()
-                       except: pass
-                   self.client = conn
-               while True:
-                   data = conn.recv(64)
-                   if not data:
+           print(f"[Capture] camera {self.cam} Exception:", e)
+       finally:
+           self.stop_event.set()
+           self.out_slot.close()
+
+
+def merge_tuples(tuples):
+   """Element-wise OR of per-camera pane tuples: a pane is occupied if any camera sees it."""
+   tuples = [t for t in tuples if t is not None]
+   if not tuples:
+       return (0,) * PANE_COUNT
+   return tuple(int(any(v)) for v in zip(*tuples))
+
+
+class InferenceThread(threading.Thread):
+   """
+   Takes the newest frame from every camera, runs depth + pane detection on the ones that need
+   it (as one (N,3,H,W) batch when the model has a dynamic batch dimension), pushes the merged
+   obstacle tuple to the ESP straight away and hands the per-camera results to the publish stage.
+   """
+   def __init__(self, sess, target_size, in_slots, out_slot, tuple_sink, stop_event):
+       super().__init__(daemon=True)
+       self.sess = sess; self.target_size = target_size
+       self.in_slots = in_slots; self.out_slot = out_slot
+       self.tuple_sink = tuple_sink; self.stop_event = stop_event
+       n = len(in_slots)
+       self.preprocessors = {}
+       self.batch_tensors = {}
+       # settings are passed explicitly rather than left to parameter defaults, which are bound
+       # at import and so would miss the overrides a vision worker gets (see WORKER_CONFIG_KEYS)
+       self.postprocess = [DepthPostprocessor(stabilizer=DepthStabilizer(DEPTH_NORM_PERCENTILES, DEPTH_SCALE_ALPHA, DEPTH_TEMPORAL_ALPHA)
+                                              if DEPTH_STABILIZE else None) for _ in range(n)]
+       self.gates = [MotionGate(MOTION_THRESHOLD, MOTION_REFRESH_FRAMES, MOTION_THUMB_SIZE) if MOTION_GATING else None
+                     for _ in range(n)]
+       self.batching = n > 1 and model_has_dynamic_batch(sess)
+       if n > 1:
+           print(f"[Inference] {n} cameras, batched: {self.batching}")
+       self.adaptive = None
+       if ADAPTIVE_RESOLUTION and model_has_dynamic_hw(sess):
+           self.adaptive = AdaptiveResolution(ADAPTIVE_SIZES, ADAPTIVE_BUDGET_MS, start=target_size,
+                                              hold_frames=ADAPTIVE_HOLD_FRAMES, hysteresis=ADAPTIVE_HYSTERESIS)
+           print("[Inference] adaptive input size enabled:", self.adaptive.sizes)
+
+
+   def preprocessor(self, size):
+       pre = self.preprocessors.get(size)
+       if pre is None:
+           pre = self.preprocessors[size] = DepthPreprocessor(size)
+       return pre
+
+
+   def batch_tensor(self, n, size):
+       t = self.batch_tensors.get((n, size))
+       if t is None:
+           t = self.batch_tensors[(n, size)] = np.empty((n, 3, size, size), dtype=np.float32)
+       return t
+
+
+   def infer(self, frames, size):
+       """Runs the model on frames, batched when possible; returns one prediction per frame."""
+       pre = self.preprocessor(size)
+       if self.batching and len(frames) > 1:
+           batch = self.batch_tensor(len(frames), size)
+           for i, frame in enumerate(frames):
+               pre(frame, out=batch[i])
+           pred = self.sess.run([self.output_name], {self.input_name: batch})[0]
+           return [pred[i:i+1] for i in range(len(frames))]
+       return [self.sess.run([self.output_name], {self.input_name: pre(frame)})[0] for frame in frames]
+
+
+   def run(self):
+       global latest_tuple, latest_panes
+       self.input_name = self.sess.get_inputs()[0].name
+       self.output_name = self.sess.get_outputs()[0].name
+       min_frame_time = 1.0 / max(1.0, TARGET_FPS)
+       n = len(self.in_slots)
+       last_seqs = [0] * n
+       last_results = [None] * n
+       frames = 0; t_fps = time.time()
+       size = self.target_size
+       try:
+           while not self.stop_event.is_set():
+               items = wait_any(self.in_slots, last_seqs, timeout=0.5)
+               if any(slot.closed for slot in self.in_slots):
+                   break
+               loop_start = time.time()
+               fresh = []
+               dropped = 0
+               for cam, (seq, item) in enumerate(items):
+                   if item is None:
+                       continue
+                   dropped += seq - last_seqs[cam] - 1 if last_seqs[cam] else 0
+                   last_seqs[cam] = seq
+                   t_cap, slot, fseq = item
+                   if loop_start - t_cap > MAX_FRAME_AGE or not slot.holds(fseq):
+                       dropped += 1
+                       continue
+                   fresh.append((cam, fseq, t_cap, slot))
+               if not fresh:
+                   with frame_lock:
+                       pipeline_stats['dropped'] += dropped
+                   continue
+
+
+               need = []; reused = 0; score = 0.0
+               for entry in fresh:
+                   cam, slot = entry[0], entry[3]
+                   if self.gates[cam] is not None:
+                       infer, score = self.gates[cam].should_infer(slot.frame)
+                       if not infer and last_results[cam] is not None:
+                           # near-static view: keep the last depth result, only the camera frame is new
+                           reused += 1
+                           continue
+                   need.append(entry)
+
+
+               if need:
+                   size = self.adaptive.size if self.adaptive else self.target_size
+                   t_infer = time.time()
+                   try:
+                       preds = self.infer([e[3].frame for e in need], size)
+                   except Exception as e:
+                       print("ONNX inference error:", e)
                        break
-               print("[AppServer] App disconnected")
-               with self.lock:
-                   if self.client:
-                       try: self.client.close()
-                       except: pass
-                       self.client = None
-           except Exception as e:
-               print("[AppServer] Exception:", e)
-               time.sleep(1)
-   def send_frame(self, jpeg_bytes):
-       with self.lock:
-           if not self.client: return
-           try:
-               ln = struct.pack(">I", len(jpeg_bytes))
-               self.client.sendall(b'FRAM' + ln + jpeg_bytes)
-           except Exception as e:
-               print("[AppServer] send_frame error:", e)
-               try: self.client.close()
-               except: pass
-               self.client = None
-   def send_location(self, loc_dict):
+                   infer_ms = (time.time() - t_infer) * 1000.0
+                   for (cam, _, _, slot), pred in zip(need, preds):
+                       h0, w0 = slot.frame.shape[:2]
+                       out = slot.depth_buffer(squeeze_depth(pred).shape)
+                       dmap = self.postprocess[cam](pred, invert=INVERT_DEPTH, out=out)
+                       tpl, picks = detect_close_panes(dmap, threshold=CLOSE_THRESH, min_area=MIN_BLOB_AREA, out_size=(w0, h0))
+                       last_results[cam] = (dmap, tpl, picks, pane_summary(dmap, threshold=CLOSE_THRESH, percentile=PANE_NEAR_PERCENTILE,
+                                                                           stride=DEPTH_SAMPLE_STRIDE))
+                   if self.adaptive:
+                       self.adaptive.update(infer_ms, any(any(r[1]) for r in last_results if r))
+
+
+               camera_tuples = [r[1] if r else None for r in last_results]
+               tpl = merge_tuples(camera_tuples)
+               panes = merge_pane_summaries([r[3] for r in last_results if r])
+               intensities = pane_intensities(panes['near'], floor=PANE_INTENSITY_FLOOR) if panes else None
+               panes['intensity'] = intensities
+               panes['cameras'] = [r[3] if r else None for r in last_results]
+               with frame_lock:
+                   latest_tuple = tpl
+                   latest_camera_tuples[:] = camera_tuples
+                   latest_panes = panes
+               self.tuple_sink.send_tuple(tpl, intensities)
+               results = []
+               for cam, seq, t_cap, slot in fresh:
+                   dmap, cam_tpl, picks, summary = last_results[cam]
+                   if dmap is not slot.depth:
+                       # reused result: carry the (model-resolution) map into this frame's slot so
+                       # it lives as long as the frame does
+                       np.copyto(slot.depth_buffer(dmap.shape), dmap)
+                       dmap = slot.depth
+                       last_results[cam] = (dmap, cam_tpl, picks, summary)
+                   results.append({'cam': cam, 'seq': seq, 't_capture': t_cap, 'frame': slot.frame,
+                                   'dmap': dmap, 'tuple': cam_tpl, 'picks': picks, 'slot': slot})
+               self.out_slot.put(results)
+
+
+               now = time.time()
+               frames += 1
+               with frame_lock:
+                   pipeline_stats['dropped'] += dropped
+                   pipeline_stats['inference_ms'] = (now - loop_start) * 1000.0
+                   pipeline_stats['latency_ms'] = (now - min(e[2] for e in fresh)) * 1000.0
+                   pipeline_stats['input_size'] = size
+                   pipeline_stats['motion'] = score
+                   pipeline_stats['reused'] += reused
+                   if now - t_fps >= 1.0:
+                       pipeline_stats['inference_fps'] = frames / (now - t_fps)
+                       frames = 0; t_fps = now
+               sleep_time = min_frame_time - (now - loop_start)
+               if sleep_time > 0:
+                   time.sleep(sleep_time)
+       finally:
+           self.stop_event.set()
+           self.out_slot.close()
+
+
+# -----------------------
+# Frame publication
+# -----------------------
+@functools.lru_cache(maxsize=1)
+def blank_jpeg(width=640, height=480):
+   """Placeholder shown on /video before the first frame; encoded once."""
+   blank = np.zeros((height, width, 3), dtype=np.uint8)
+   _, buf = cv2.imencode('.jpg', blank, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+   return buf.tobytes()
+
+
+class FramePublisher:
+   """
+   Latest encoded JPEG per output stream ('overlay', 'camera', ...), tagged with the capture
+   sequence number. Each stream is encoded at most once per captured frame and every consumer
+   gets the same immutable bytes object. Readers block in wait_newer() until a new frame is
+   published instead of polling.
+   """
+   def __init__(self, quality=JPEG_QUALITY):
+       self.lock = threading.Lock()
+       self.cond = threading.Condition(self.lock)
+       self.params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+       self.streams = {}
+
+
+   def encode(self, image):
+       ok, buf = cv2.imencode('.jpg', image, self.params)
+       return buf.tobytes() if ok else None
+
+
+   def publish_encoded(self, name, seq, jpg):
+       """Publish an encoded JPEG; VisionPipeline.publish encodes once per frame slot."""
+       with self.cond:
+           self.streams[name] = (seq, jpg)
+           self.cond.notify_all()
+       return jpg
+
+
+   def latest(self, name):
+       """Returns (seq, jpeg bytes); seq 0 and the blank placeholder before the first publish."""
        with self.lock:
-           if not self.client: return
+           cur = self.streams.get(name)
+       if cur is None:
+           return 0, blank_jpeg()
+       return cur
+
+
+   def wait_newer(self, name, last_seq, timeout=None):
+       """
+       Block until stream `name` has a frame newer than last_seq. Returns (seq, jpeg bytes),
+       or (last_seq, None) on timeout. A reader that falls behind simply gets the newest
+       frame, so slow clients skip frames rather than queueing them.
+       """
+       def newer():
+           cur = self.streams.get(name)
+           return cur is not None and cur[0] != last_seq
+       with self.cond:
+           if not self.cond.wait_for(newer, timeout):
+               return last_seq, None
+           return self.streams[name]
+
+
+frame_publisher = FramePublisher()
+
+
+class SharedFrameRing:
+   """
+   Fixed ring of SHM_RING_SLOTS byte slots in multiprocessing.shared_memory, written by the
+   vision worker and read by the front-end process. Each slot starts with a (seq, length)
+   header; the writer clears seq before copying the payload and sets it afterwards, and the
+   reader checks it on both sides of its copy, so a slot overwritten mid-read is detected
+   and the frame skipped rather than served torn.
+   """
+   HEADER = struct.Struct("<QI4x")
+
+
+   def __init__(self, name=None, slots=SHM_RING_SLOTS, slot_bytes=SHM_SLOT_BYTES):
+       self.slots = slots
+       self.slot_bytes = slot_bytes
+       self.stride = self.HEADER.size + slot_bytes
+       self.owner = name is None
+       if self.owner:
+           self.shm = shared_memory.SharedMemory(create=True, size=slots * self.stride)
+           self.shm.buf[:slots * self.stride] = bytes(slots * self.stride)
+       else:
+           self.shm = shared_memory.SharedMemory(name=name)
+       self.name = self.shm.name
+       self.next_slot = 0
+
+
+   def write(self, seq, payload):
+       """Copy payload into the next slot. Returns the slot index, or None if it does not fit."""
+       n = len(payload)
+       if n > self.slot_bytes:
+           print(f"[SharedFrameRing] frame of {n} bytes exceeds slot size {self.slot_bytes}, dropped")
+           return None
+       idx = self.next_slot
+       self.next_slot = (idx + 1) % self.slots
+       off = idx * self.stride
+       buf = self.shm.buf
+       self.HEADER.pack_into(buf, off, 0, 0)
+       start = off + self.HEADER.size
+       buf[start:start + n] = payload
+       self.HEADER.pack_into(buf, off, seq, n)
+       return idx
+
+
+   def read(self, idx, seq):
+       """Bytes written to slot idx under seq, or None if the writer has since lapped it."""
+       off = idx * self.stride
+       buf = self.shm.buf
+       cur, n = self.HEADER.unpack_from(buf, off)
+       if cur != seq:
+           return None
+       start = off + self.HEADER.size
+       data = bytes(buf[start:start + n])
+       if self.HEADER.unpack_from(buf, off)[0] != seq:
+           return None
+       return data
+
+
+   def close(self):
+       self.shm.close()
+       if self.owner:
            try:
-               payload = json.dumps(loc_dict).encode('utf-8')
-               ln = struct.pack(">I", len(payload))
-               self.client.sendall(b'LOC ' + ln + payload)
-           except Exception as e:
-               print("[AppServer] send_location error:", e)
-               try: self.client.close()
-               except: pass
-               self.client = None
+               self.shm.unlink()
+           except FileNotFoundError:
+               pass
+
+
+def stream_name(kind, cam=0):
+   """Camera 0 keeps the plain names ('overlay', 'camera'); others get their index appended."""
+   return kind if cam == 0 else f"{kind}{cam}"
+
+
+class OverlayRenderer:
+   """
+   Draws the RGB | depth preview into buffers reused across frames (publish stage only).
+   The depth map is upsampled to the frame size here, for display only.
+   """
+   def __init__(self):
+       self.shape = None
+
+
+   def ensure_buffers(self, h0, w0):
+       if self.shape != (h0, w0):
+           self.depth = np.empty((h0, w0), dtype=np.float32)
+           self.disp = np.empty((h0, w0), dtype=np.uint8)
+           self.combined = np.empty((h0, 2 * w0, 3), dtype=np.uint8)
+           # the depth half is colorized and annotated in place inside the combined canvas
+           self.vis = self.combined[:, w0:]
+           self.shape = (h0, w0)
+
+
+   def __call__(self, frame, dmap, tpl, picks):
+       h0, w0 = frame.shape[:2]
+       self.ensure_buffers(h0, w0)
+       interp = cv2.INTER_CUBIC if USE_CUBIC_RESIZE else cv2.INTER_LINEAR
+       cv2.resize(dmap, (w0, h0), dst=self.depth, interpolation=interp)
+       # cubic overshoots slightly outside [0, 1]; clip so the uint8 cast cannot wrap
+       np.clip(self.depth, 0.0, 1.0, out=self.depth)
+       vis = colorize_depth(self.depth, out_u8=self.disp, out=self.vis)
+       for i in range(1, len(tpl)):
+           x = i * w0 // len(tpl)
+           cv2.line(vis, (x,0), (x,h0), (255,255,255), 2)
+       for pane_idx, b in picks:
+           x,y,ww,hh = b['bbox']
+           color = (0,255,0) if tpl[pane_idx] else (0,0,255)
+           cv2.rectangle(vis, (x,y), (x+ww, y+hh), color, 2)
+           cv2.putText(vis, f"p{pane_idx}:{b['mean_depth']:.2f}", (x,y-6), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color,1)
+
+
+       combined = self.combined
+       combined[:, :w0] = frame
+       cv2.putText(combined, f"TUPLE: {tpl}", (10,30),
+                   cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0,255,0), 2, cv2.LINE_AA)
+       return combined
 
 
 # -----------------------
@@ -527,42 +1758,12 @@ ESP_CMD_HOST = "10.87.74.192"   # change to your ESP IP
 ESP_CMD_PORT = 8001
 
 
-def _send_cmd_to_esp(cmd_text, timeout_connect=1.0, timeout_recv=0.5):
+def _send_cmd_to_esp(cmd_text, timeout=None):
    """
-   Helper to send plain-text command to ESP command port and return (ok, resp_or_error).
+   Send a plain-text command to the ESP command port over the shared persistent channel
+   (esp_cmd.py) and return (ok, resp_or_error); resp is None when the ESP did not answer.
    """
-   text = (cmd_text.strip() + "\n").encode('ascii')
-   try:
-       s = socket.create_connection((ESP_CMD_HOST, ESP_CMD_PORT), timeout=timeout_connect)
-   except Exception as e:
-       return False, f"connect_failed: {e}"
-   try:
-       s.sendall(text)
-   except Exception as e:
-       try:
-           s.close()
-       except:
-           pass
-       return False, f"send_failed: {e}"
-   # optional response read
-   try:
-       s.settimeout(timeout_recv)
-       resp = s.recv(512)
-       try:
-           s.close()
-       except:
-           pass
-       # return decoded response
-       try:
-           return True, resp.decode('ascii', 'ignore')
-       except:
-           return True, resp.decode('ascii', errors='ignore') if hasattr(resp, 'decode') else True, str(resp)
-   except Exception:
-       try:
-           s.close()
-       except:
-           pass
-       return True, None
+   return esp_cmd.get_channel(ESP_CMD_HOST, ESP_CMD_PORT).send(cmd_text, timeout=timeout)
 
 
 @flask_app.route('/esp/cmd', methods=['POST', 'OPTIONS'])
@@ -601,21 +1802,45 @@ def esp_proxy_backward():
    return esp_cmd_proxy()
 
 
-@flask_app.route('/video')
-def video_mjpeg():
+mjpeg_clients = 0
+
+
+@flask_app.route('/video', defaults={'cam': 0})
+@flask_app.route('/video/<int:cam>')
+def video_mjpeg(cam):
+   global mjpeg_clients
+   if cam >= max(1, len(VIDEO_SOURCES)):
+       return jsonify({"error": "no such camera"}), 404
+   name = stream_name('overlay', cam)
+   with frame_lock:
+       if mjpeg_clients >= MJPEG_MAX_CLIENTS:
+           return jsonify({"error": "too many viewers"}), 503
+       mjpeg_clients += 1
+
+
    def gen():
-       global latest_frame_jpg
+       seq, b = frame_publisher.latest(name)
        while True:
-           with frame_lock:
-               b = latest_frame_jpg
-           if b is None:
-               blank = np.zeros((480,640,3), dtype=np.uint8)
-               ret, tmp = cv2.imencode('.jpg', blank, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-               b = tmp.tobytes()
            yield (b'--frame\r\n'
                   b'Content-Type: image/jpeg\r\n\r\n' + b + b'\r\n')
-           time.sleep(0.03)
-   return Response(gen(), mimetype='multipart/x-mixed-replace; boundary=frame')
+           # the yield above only returns once this client has taken the frame, so a slow
+           # viewer just picks up whatever is newest next time round
+           new_seq, new_b = frame_publisher.wait_newer(name, seq, timeout=MJPEG_KEEPALIVE)
+           if new_b is not None:
+               seq, b = new_seq, new_b
+
+
+   def release():
+       global mjpeg_clients
+       with frame_lock:
+           mjpeg_clients -= 1
+
+
+   resp = Response(gen(), mimetype='multipart/x-mixed-replace; boundary=frame')
+   # the server closes the response whether or not gen() ever started (HEAD, client gone
+   # before the first chunk), so the slot is given back on every path
+   resp.call_on_close(release)
+   return resp
 
 
 @flask_app.route('/location')
@@ -629,8 +1854,16 @@ def location_http():
 def status_http():
    with frame_lock:
        tpl = latest_tuple
+       cam_tuples = list(latest_camera_tuples)
+       panes = latest_panes
        loc = latest_location.copy()
-   return jsonify({"tuple": tpl, "location": loc, "ts": time.time()})
+       stats = dict(pipeline_stats)
+       stats['mjpeg_clients'] = mjpeg_clients
+   if device_gateway is not None:
+       counts = device_gateway.client_counts()
+       stats['esp_clients'] = counts['esp']; stats['app_clients'] = counts['app']
+   return jsonify({"tuple": tpl, "camera_tuples": cam_tuples, "panes": panes, "location": loc, "pipeline": stats,
+                   "session": session_info, "auth": password_hasher.stats(), "ts": time.time()})
 
 
 @flask_app.route('/signup', methods=['POST', 'OPTIONS'])
@@ -668,7 +1901,10 @@ def signup_http():
        return jsonify({"error": "password required"}), 400
 
 
-   ok, err = db_insert_user(username, password, full_name, age, condition, caretaker_name, caretaker_contact)
+   try:
+       ok, err = db_insert_user(username, password, full_name, age, condition, caretaker_name, caretaker_contact)
+   except auth.HasherBusy:
+       return jsonify({"error": "server busy, try again"}), 503, {"Retry-After": "1"}
    if not ok:
        status = 409 if err == "username exists" else 500
        return jsonify({"error": err}), status
@@ -699,27 +1935,55 @@ def login_http():
        return jsonify({"error": "username and password required"}), 400
 
 
+   allowed, retry_after = login_limiter.allow(username)
+   if not allowed:
+       return jsonify({"error": "too many attempts"}), 429, {"Retry-After": str(int(retry_after) + 1)}
+
+
    user = db_get_user(username)
    if not user:
        return jsonify({"error": "invalid credentials"}), 401
 
 
    stored_hash = user.get('password_hash')
-   if not check_password_hash(stored_hash, password):
+   try:
+       valid = password_hasher.check(stored_hash, password)
+   except auth.HasherBusy:
+       return jsonify({"error": "server busy, try again"}), 503, {"Retry-After": "1"}
+   if not valid:
        return jsonify({"error": "invalid credentials"}), 401
 
 
-   return jsonify({"ok": True}), 200
+   return jsonify({"ok": True, "token": session_tokens.issue(username), "expires_in": session_tokens.max_age}), 200
+
+
+def request_session_user():
+   """
+   (present, username) for the request's "Authorization: Bearer <token>" header. username is
+   None when no token was sent or the token does not verify. Checked from the signature only.
+   """
+   scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+   if scheme.lower() != 'bearer' or not token.strip():
+       return False, None
+   return True, session_tokens.verify(token.strip())
 
 
 @flask_app.route('/profile/<username>', methods=['GET'])
 def profile_http(username):
    username = username.strip()
-   row = db_get_user(username)
+   present, session_user = request_session_user()
+   if present and session_user is None:
+       return jsonify({"error": "invalid or expired session"}), 401
+   if present and session_user != username:
+       return jsonify({"error": "forbidden"}), 403
+   row = db_get_profile(username)
    if not row:
        return jsonify({"error": "not found"}), 404
-   row.pop('password_hash', None)
-   return jsonify({"profile": row})
+   resp = jsonify({"profile": row})
+   # validator from the row's identity and last write; clients revalidate and mostly get 304s
+   resp.set_etag(f"{zlib.crc32(username.encode('utf-8')):08x}-{row.get('updated_at') or 0:.6f}")
+   resp.headers['Cache-Control'] = 'private, no-cache'
+   return resp.make_conditional(request)
 
 
 def run_flask():
@@ -772,140 +2036,350 @@ def set_location_http():
 
 
 # -----------------------
-# Main loop
+# Vision pipeline
 # -----------------------
-def run_servers_and_loop():
-   print("Starting merged MiDaS app with Flask endpoints")
-   print("MODEL_PATH:", MODEL_PATH)
-   sess = None
-   try:
-       sess = choose_session(MODEL_PATH)
-   except Exception as e:
-       print("Failed to create ONNX session:", e)
-       sys.exit(1)
-   target_size = infer_model_input_size(sess)
-   print("model target input:", target_size)
+class VisionPipeline:
+   """
+   The ONNX session, one capture thread per VIDEO_SOURCES entry, the inference thread and the
+   per-camera overlay renderers of the publish stage. Runs in the main process, or inside the
+   vision worker process when VISION_WORKER is set.
+   """
+   def __init__(self, tuple_sink, stop_event):
+       variant, model_path, drift = resolve_model_variant()
+       print("MODEL_PATH:", model_path, f"({variant})")
+       try:
+           self.sess = choose_session(model_path)
+       except Exception as e:
+           print("Failed to create ONNX session:", e)
+           sys.exit(1)
+       session_info['variant'] = variant
+       if drift:
+           session_info['drift'] = drift
+       self.target_size = infer_model_input_size(self.sess)
+       print("model target input:", self.target_size)
+
+
+       sources = list(VIDEO_SOURCES) or [VIDEO_SOURCE]
+       self.caps = []
+       for src in sources:
+           cap = cv2.VideoCapture(src)
+           if not cap.isOpened():
+               print("ERROR: Could not open video source:", src)
+               sys.exit(1)
+           try:
+               # keep the driver from queueing stale frames; not every backend honours this
+               cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+           except Exception:
+               pass
+           self.caps.append(cap)
+       pipeline_stats['capture_fps'] = [0.0] * len(self.caps)
+       # cameras deliver in real time; a file is played at its own frame rate (or TARGET_FPS)
+       pace = []
+       for src, cap in zip(sources, self.caps):
+           if isinstance(src, str) and os.path.isfile(src):
+               fps = cap.get(cv2.CAP_PROP_FPS)
+               pace.append(fps if 0 < fps <= 240 else TARGET_FPS)
+           else:
+               pace.append(None)
 
 
-   cap = cv2.VideoCapture(VIDEO_SOURCE)
-   if not cap.isOpened():
-       print("ERROR: Could not open video source:", VIDEO_SOURCE)
-       sys.exit(1)
+       self.stop_event = stop_event
+       capture_cond = threading.Condition()
+       capture_slots = [LatestSlot(capture_cond) for _ in self.caps]
+       self.frame_rings = [FrameRing(FRAME_RING_SLOTS) for _ in self.caps]
+       self.result_slot = LatestSlot()
+       self.capture_threads = [CaptureThread(cap, slot, stop_event, cam=i, ring=ring, pace_fps=fps)
+                               for i, (cap, slot, ring, fps) in enumerate(zip(self.caps, capture_slots, self.frame_rings, pace))]
+       self.inference_thread = InferenceThread(self.sess, self.target_size, capture_slots, self.result_slot, tuple_sink, stop_event)
+       self.renderers = [OverlayRenderer() for _ in self.caps]
 
 
-   input_name = sess.get_inputs()[0].name
-   output_name = sess.get_outputs()[0].name
+   def start(self):
+       for t in self.capture_threads:
+           t.start()
+       self.inference_thread.start()
 
 
-   esp_server = ESPServer(ESP_HOST, ESP_PORT)
-   esp_server.start()
-   app_server = AppServer(APP_HOST, APP_PORT)
-   app_server.start()
+   def results(self, last_seq, timeout=0.1):
+       """Newest list of per-camera inference results, see InferenceThread."""
+       return self.result_slot.get(last_seq, timeout=timeout)
 
 
-   flask_thread = threading.Thread(target=run_flask, daemon=True)
-   flask_thread.start()
+   def render(self, res):
+       return self.renderers[res['cam']](res['frame'], res['dmap'], res['tuple'], res['picks'])
+
+
+   def publish(self, res, name, image):
+       """
+       Encode image (drawn from res) and publish it as stream name, keeping the JPEG in the
+       frame's ring slot. Returns None without publishing if capture reused the slot meanwhile,
+       since the image may then mix two frames; a newer result is already on its way.
+       """
+       slot, seq = res['slot'], res['seq']
+       jpg = slot.jpegs.get((seq, name))
+       if jpg is None:
+           jpg = frame_publisher.encode(image)
+           if jpg is None or not slot.holds(seq):
+               return None
+           # if capture laps the slot after the check, this entry is never looked up again and
+           # goes with the next begin_write()
+           slot.jpegs[(seq, name)] = jpg
+       return frame_publisher.publish_encoded(name, seq, jpg)
+
+
+   def close(self):
+       self.stop_event.set()
+       for t in self.capture_threads:
+           t.join(timeout=2.0)
+       self.inference_thread.join(timeout=2.0)
+       for cap in self.caps:
+           cap.release()
+
+
+# -----------------------
+# Vision worker process
+# -----------------------
+# module globals copied into the worker, so runtime overrides of these reach the spawned process
+# (which otherwise re-imports the file's values). This is every setting the capture, inference,
+# render and encode stages read: add new ones here, and pass them explicitly where the pipeline
+# calls something that takes them as a parameter default.
+WORKER_CONFIG_KEYS = ('MODEL_PATH', 'MODEL_VARIANT', 'MODEL_VARIANTS', 'AUTO_VARIANT_ORDER', 'VARIANT_MIN_PANE_AGREEMENT',
+                      'ORT_PROFILE', 'ORT_PROFILES', 'VIDEO_SOURCE', 'VIDEO_SOURCES', 'TARGET_FPS', 'INVERT_DEPTH',
+                      'USE_CUBIC_RESIZE', 'MAX_FRAME_AGE', 'FRAME_RING_SLOTS',
+                      'ADAPTIVE_RESOLUTION', 'ADAPTIVE_SIZES', 'ADAPTIVE_BUDGET_MS', 'ADAPTIVE_CLEAR_BUDGET_SCALE',
+                      'ADAPTIVE_HYSTERESIS', 'ADAPTIVE_HOLD_FRAMES',
+                      'MOTION_GATING', 'MOTION_THUMB_SIZE', 'MOTION_THRESHOLD', 'MOTION_REFRESH_FRAMES',
+                      'DEPTH_STABILIZE', 'DEPTH_NORM_PERCENTILES', 'DEPTH_SAMPLE_STRIDE', 'DEPTH_SCALE_ALPHA',
+                      'DEPTH_TEMPORAL_ALPHA',
+                      'CLOSE_THRESH', 'MIN_BLOB_AREA', 'PANE_COUNT', 'PANE_NEAR_PERCENTILE', 'PANE_INTENSITY_FLOOR',
+                      'JPEG_QUALITY', 'SHM_RING_SLOTS', 'SHM_SLOT_BYTES')
+
+
+class PipeSink:
+   """
+   Worker side of the notification pipe. Stands in for the DeviceGateway inside the worker:
+   InferenceThread calls send_tuple() and the tuple goes to the front-end, which owns the sockets.
+   """
+   def __init__(self, conn):
+       self.conn = conn
+       self.lock = threading.Lock()
 
 
-   min_frame_time = 1.0 / max(1.0, TARGET_FPS)
-   last_loc_send = 0.0
+   def send(self, msg):
+       with self.lock:
+           self.conn.send(msg)
+
 
+   def send_tuple(self, tpl, intensities=None):
+       with frame_lock:
+           camera_tuples = list(latest_camera_tuples)
+           panes = latest_panes
+       self.send(('tuple', tpl, camera_tuples, intensities, panes))
 
+
+def vision_worker_main(conn, ring_name, mp_stop, camera_wanted, config):
+   """
+   Entry point of the vision worker process: capture, inference, overlay rendering and JPEG
+   encoding. Encoded frames go into the shared ring and only (stream, seq, slot) crosses the pipe.
+   """
+   globals().update(config)
+   global frame_publisher
+   frame_publisher = FramePublisher(quality=JPEG_QUALITY)
+   ring = SharedFrameRing(ring_name, slots=SHM_RING_SLOTS, slot_bytes=SHM_SLOT_BYTES)
+   sink = PipeSink(conn)
+   stop_event = threading.Event()
+   pipeline = VisionPipeline(sink, stop_event)
+   sink.send(('session', dict(session_info)))
+   pipeline.start()
+
+
+   last_seq = 0; ring_seq = 0
+   t_stats = time.time()
    try:
-       while True:
-           loop_start = time.time()
-           ret, frame = cap.read()
-           if not ret:
-               print("No frame, exiting")
-               break
-           frame = cv2.flip(frame, 1)
-           frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
-           h0, w0 = frame.shape[:2]
+       while not (stop_event.is_set() or mp_stop.is_set()):
+           seq, results = pipeline.results(last_seq, timeout=0.1)
+           now = time.time()
+           if now - t_stats >= 1.0:
+               with frame_lock:
+                   stats = dict(pipeline_stats)
+               sink.send(('stats', stats))
+               t_stats = now
+           if results is None:
+               continue
+           last_seq = seq
+           for res in results:
+               cam = res['cam']
+               streams = [(stream_name('overlay', cam), pipeline.render(res))]
+               if cam == 0 and camera_wanted.is_set():
+                   streams.append(('camera', res['frame']))
+               for name, image in streams:
+                   jpg = pipeline.publish(res, name, image)
+                   if jpg is None:
+                       continue
+                   ring_seq += 1
+                   idx = ring.write(ring_seq, jpg)
+                   if idx is not None:
+                       sink.send(('frame', name, res['seq'], idx, ring_seq))
+   except (KeyboardInterrupt, BrokenPipeError, EOFError):
+       pass
+   finally:
+       pipeline.close()
+       try:
+           with frame_lock:
+               stats = dict(pipeline_stats)
+           sink.send(('stats', stats))
+           sink.send(('stopped',))
+       except Exception:
+           pass
+       conn.close()
+       ring.close()
 
 
-           inp = preprocess(frame, target_size)
-           try:
-               out = sess.run([output_name], {input_name: inp})
-               pred = out[0]
-           except Exception as e:
-               print("ONNX inference error:", e)
-               break
-           dmap = postprocess_depth(pred, w0, h0, invert=INVERT_DEPTH)
-           depth_viz = colorize_depth(dmap)
+class VisionWorkerClient(threading.Thread):
+   """
+   Front-end side of the vision worker: starts the process and turns its pipe messages back
+   into what the in-process pipeline would have done (shared state, ESP tuple, published
+   frames, app stream), so Flask and the TCP servers work unchanged.
+   """
+   def __init__(self, gateway, stop_event):
+       super().__init__(daemon=True)
+       self.gateway = gateway; self.stop_event = stop_event
+       ctx = mp.get_context('spawn')
+       self.ring = SharedFrameRing()
+       self.conn, child_conn = ctx.Pipe(duplex=False)
+       self.mp_stop = ctx.Event()
+       self.camera_wanted = ctx.Event()
+       config = {k: globals()[k] for k in WORKER_CONFIG_KEYS}
+       self.proc = ctx.Process(target=vision_worker_main, name="vision-worker", daemon=True,
+                               args=(child_conn, self.ring.name, self.mp_stop, self.camera_wanted, config))
 
 
-           tpl, picks = detect_close_panes(dmap, threshold=CLOSE_THRESH, min_area=MIN_BLOB_AREA)
+   def run(self):
+       self.proc.start()
+       print("[VisionWorker] started, pid", self.proc.pid)
+       try:
+           while not self.stop_event.is_set():
+               if self.gateway.has_client():
+                   self.camera_wanted.set()
+               else:
+                   self.camera_wanted.clear()
+               if not self.conn.poll(0.1):
+                   if not self.proc.is_alive():
+                       print("[VisionWorker] worker exited with code", self.proc.exitcode)
+                       break
+                   continue
+               try:
+                   msg = self.conn.recv()
+               except EOFError:
+                   break
+               if msg[0] == 'stopped':
+                   print("[VisionWorker] worker stopped")
+                   break
+               self.handle(msg)
+       finally:
+           self.stop_event.set()
+
+
+   def handle(self, msg):
+       global latest_tuple, latest_panes
+       kind = msg[0]
+       if kind == 'frame':
+           _, name, seq, idx, ring_seq = msg
+           jpg = self.ring.read(idx, ring_seq)
+           if jpg is None:
+               # lapped by the writer: a newer frame is already on its way
+               return
+           frame_publisher.publish_encoded(name, seq, jpg)
+           if name == 'camera':
+               self.gateway.send_frame(jpg)
+       elif kind == 'tuple':
+           _, tpl, camera_tuples, intensities, panes = msg
            with frame_lock:
-               global latest_tuple
                latest_tuple = tpl
+               latest_camera_tuples[:] = camera_tuples
+               latest_panes = panes
+           self.gateway.send_tuple(tpl, intensities)
+       elif kind == 'stats':
+           with frame_lock:
+               pipeline_stats.update(msg[1])
+       elif kind == 'session':
+           session_info.update(msg[1])
+           session_info['vision_worker_pid'] = self.proc.pid
 
 
-           esp_server.send_tuple(tpl)
+   def close(self):
+       self.mp_stop.set()
+       self.proc.join(timeout=5.0)
+       if self.proc.is_alive():
+           self.proc.terminate()
+           self.proc.join(timeout=1.0)
+       self.conn.close()
+       self.ring.close()
 
 
-           vis = depth_viz.copy()
-           pane_w = w0 // 3
-           cv2.line(vis, (pane_w,0), (pane_w,h0), (255,255,255), 2)
-           cv2.line(vis, (2*pane_w,0), (2*pane_w,h0), (255,255,255), 2)
-           for pane_idx, b in picks:
-               x,y,ww,hh = b['bbox']
-               color = (0,255,0) if tpl[pane_idx] else (0,0,255)
-               cv2.rectangle(vis, (x,y), (x+ww, y+hh), color, 2)
-               cv2.putText(vis, f"p{pane_idx}:{b['mean_depth']:.2f}", (x,y-6), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color,1)
+# -----------------------
+# Main loop
+# -----------------------
+def run_servers_and_loop():
+   print("Starting merged MiDaS app with Flask endpoints")
+   init_db()
+   # hash workers are started (and their imports paid for) before capture and inference run
+   password_hasher.start()
+   if session_tokens.ephemeral:
+       print("[auth] SESSION_SECRET not set; session tokens are valid until restart")
 
 
-           combined = np.concatenate((frame, vis), axis=1)
-           cv2.putText(combined, f"TUPLE: {tpl}", (10,30),
-                       cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0,255,0), 2, cv2.LINE_AA)
+   global device_gateway
+   device_gateway = gateway = DeviceGateway()
+   gateway.start()
 
 
-           _, jpg = cv2.imencode('.jpg', combined, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-           jpg_bytes = jpg.tobytes()
+   flask_thread = threading.Thread(target=run_flask, daemon=True)
+   flask_thread.start()
 
 
-           with frame_lock:
-               global latest_frame_jpg
-               latest_frame_jpg = jpg_bytes
+   stop_event = threading.Event()
+   location_service = LocationService(gateway, stop_event)
+   location_service.start()
+   if VISION_WORKER:
+       run_worker_loop(gateway, stop_event)
+       return
 
 
-           _, cam_jpg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-           app_server.send_frame(cam_jpg.tobytes())
+   pipeline = VisionPipeline(gateway, stop_event)
+   pipeline.start()
 
 
-           now = time.time()
-           if now - last_loc_send > GPS_POLL_INTERVAL:
-               gps_res = get_precise_gps()
-               if gps_res:
-                   lat, lon, acc, src = gps_res
-                   with frame_lock:
-                       latest_location['lat'] = lat
-                       latest_location['lon'] = lon
-                       latest_location['host_ip'] = latest_location.get('host_ip')
-                       latest_location['timestamp'] = now
-                       latest_location['gps_source'] = src
-                       latest_location['accuracy'] = acc
-                   print(f"[GPS] precise coords from {src}: {lat},{lon} (acc={acc})")
-               else:
-                   loc = get_location()
-                   with frame_lock:
-                       latest_location['lat'] = loc.get('lat')
-                       latest_location['lon'] = loc.get('lon')
-                       latest_location['host_ip'] = loc.get('host_ip')
-                       latest_location['timestamp'] = loc.get('timestamp')
-                   print("[GPS] precise not found, used IP fallback:", latest_location.get('host_ip'))
-               app_server.send_location(latest_location)
-               last_loc_send = now
+   # publish stage: overlay, encode and fan-out run here so they never hold up capture or inference
+   last_seq = 0
 
 
-           cv2.imshow("RGB (L) | Depth (R)", combined)
-           if cv2.waitKey(1) & 0xFF == ord('q'):
-               break
+   try:
+       while not stop_event.is_set():
+           seq, results = pipeline.results(last_seq, timeout=0.1)
+           if results is None:
+               # keep the preview window responsive while waiting for inference
+               if cv2.waitKey(1) & 0xFF == ord('q'):
+                   break
+               continue
+           last_seq = seq
+           for res in results:
+               cam = res['cam']
+               frame = res['frame']
+               combined = pipeline.render(res)
+
 
+               pipeline.publish(res, stream_name('overlay', cam), combined)
+               if cam == 0 and gateway.has_client():
+                   jpg = pipeline.publish(res, 'camera', frame)
+                   if jpg is not None:
+                       gateway.send_frame(jpg)
 
-           elapsed = time.time() - loop_start
-           sleep_time = min_frame_time - elapsed
-           if sleep_time > 0:
-               time.sleep(sleep_time)
+
+               title = "RGB (L) | Depth (R)" if cam == 0 else f"RGB (L) | Depth (R) - camera {cam}"
+               cv2.imshow(title, combined)
+           if cv2.waitKey(1) & 0xFF == ord('q'):
+               break
 
 
    except KeyboardInterrupt:
@@ -913,11 +2387,28 @@ def run_servers_and_loop():
 
 
    finally:
-       cap.release()
+       pipeline.close()
        cv2.destroyAllWindows()
+       password_hasher.close()
+       print("Shutting down.")
+
+
+def run_worker_loop(gateway, stop_event):
+   """Headless main thread for VISION_WORKER mode: the preview lives on /video."""
+   client = VisionWorkerClient(gateway, stop_event)
+   client.start()
+   try:
+       while not stop_event.wait(0.5):
+           pass
+   except KeyboardInterrupt:
+       print("Interrupted by user")
+   finally:
+       stop_event.set()
+       client.join(timeout=2.0)
+       client.close()
+       password_hasher.close()
        print("Shutting down.")
 
 
 if __name__ == "__main__":
    run_servers_and_loop()
-
@@ -0,0 +1,205 @@
+"""
+user_store.py
+
+SQLite-backed user accounts for server.py.
+
+- Connections are opened once and reused from a small pool. Flask's threaded server runs every
+  request on a fresh thread, so thread-local connections would be reopened per request.
+- WAL journaling, so profile reads are not blocked by a signup being written.
+- A busy timeout, so concurrent writers wait briefly instead of failing with "database is locked".
+- Schema migrations keyed on PRAGMA user_version. A users.db created by the old code
+  (user_version 0) is upgraded in place.
+- A read-through LRU cache with TTL for profile rows (never the password hash), dropped for a
+  user whenever that user's row is written.
+
+The SQL lives in module constants so sqlite3's per-connection statement cache reuses the
+prepared statements.
+"""
+import collections
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000
+PROFILE_CACHE_SIZE = 256
+PROFILE_CACHE_TTL = 30.0   # bounds staleness if another process writes the database
+
+USER_COLUMNS = ('username', 'password_hash', 'full_name', 'age', 'condition', 'caretaker_name',
+                'caretaker_contact', 'updated_at')
+PROFILE_COLUMNS = tuple(c for c in USER_COLUMNS if c != 'password_hash')
+
+SQL_INSERT_USER = '''
+    INSERT INTO users(username, password_hash, full_name, age, condition, caretaker_name, caretaker_contact, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_GET_USER = 'SELECT * FROM users WHERE username = ?'
+SQL_GET_PROFILE = f"SELECT {', '.join(PROFILE_COLUMNS)} FROM users WHERE username = ?"
+
+
+def _migrate_1(conn):
+    # the table as the original server.py created it
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL,
+            full_name TEXT,
+            age INTEGER,
+            condition TEXT,
+            caretaker_name TEXT,
+            caretaker_contact TEXT
+        )
+    ''')
+
+
+def _migrate_2(conn):
+    # last-modified time per row, for cache validation on /profile
+    cols = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+    if 'updated_at' not in cols:
+        conn.execute('ALTER TABLE users ADD COLUMN updated_at REAL')
+    conn.execute('UPDATE users SET updated_at = ? WHERE updated_at IS NULL', (time.time(),))
+
+
+# MIGRATIONS[i] upgrades a database from user_version i to i + 1
+MIGRATIONS = (_migrate_1, _migrate_2)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class ProfileCache:
+    """Thread-safe LRU of profile rows with a TTL. Callers get copies, so cached rows cannot be mutated."""
+    def __init__(self, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.maxsize = maxsize; self.ttl = ttl
+        self.data = collections.OrderedDict()   # username -> (expires, row)
+        self.lock = threading.Lock()
+        self.hits = 0; self.misses = 0
+
+    def get(self, username):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.data.get(username)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self.data[username]
+                self.misses += 1
+                return None
+            self.data.move_to_end(username)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, username, row):
+        with self.lock:
+            self.data[username] = (time.monotonic() + self.ttl, dict(row))
+            self.data.move_to_end(username)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.data.pop(username, None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+
+class UserStore:
+    def __init__(self, db_path, pool_size=POOL_SIZE, busy_timeout_ms=BUSY_TIMEOUT_MS, profile_cache=None):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.pool = queue.LifoQueue(pool_size)
+        self.migrated = False
+        self.migrate_lock = threading.Lock()
+        self.profiles = profile_cache or ProfileCache()
+
+    # ---------------- connections ----------------
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000.0,
+                               check_same_thread=False, cached_statements=64)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA journal_mode = WAL')
+        # WAL + NORMAL is still safe against corruption; only the last commits can be lost on power cut
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a pooled connection; it goes back to the pool (or is closed if the pool is full)."""
+        self.migrate()
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self.pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def migrate(self):
+        """Bring the schema to SCHEMA_VERSION; runs once per process."""
+        if self.migrated:
+            return
+        with self.migrate_lock:
+            if self.migrated:
+                return
+            conn = self._connect()
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                for step in range(version, SCHEMA_VERSION):
+                    with conn:
+                        MIGRATIONS[step](conn)
+                        conn.execute(f'PRAGMA user_version = {step + 1}')
+                    print(f"[UserStore] migrated {self.db_path} to schema version {step + 1}")
+            finally:
+                conn.close()
+            self.migrated = True
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    # ---------------- queries ----------------
+    def insert_user(self, username, password_hash, full_name="", age=None, condition="", caretaker_name="", caretaker_contact=""):
+        """Returns (ok, error); error is "username exists" for a duplicate username."""
+        try:
+            with self.connection() as conn, conn:
+                conn.execute(SQL_INSERT_USER, (username, password_hash, full_name, age, condition,
+                                               caretaker_name, caretaker_contact, time.time()))
+            return True, None
+        except sqlite3.IntegrityError:
+            return False, "username exists"
+        except Exception as e:
+            return False, str(e)
+        finally:
+            # every write path drops the user's cached profile, whatever the outcome
+            self.profiles.invalidate(username)
+
+    def get_user(self, username):
+        """Full row including password_hash, or None."""
+        with self.connection() as conn:
+            row = conn.execute(SQL_GET_USER, (username,)).fetchone()
+        return dict(row) if row else None
+
+    def get_profile(self, username):
+        """Row without password_hash, or None. Served from the profile cache when possible."""
+        row = self.profiles.get(username)
+        if row is not None:
+            return row
+        with self.connection() as conn:
+            row = conn.execute(SQL_GET_PROFILE, (username,)).fetchone()
+        if not row:
+            return None
+        row = dict(row)
+        self.profiles.put(username, row)
+        return row